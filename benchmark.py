@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+"""
+Offline benchmarks for the 3asafeer chef.
+
+Replays recorded story pages and static assets from a local HTTP server and
+times each stage of the chef separately. Results are written as JSON so they
+can be compared between versions.
+
+    ./benchmark.py record --books=5         # needs network and PhantomJS
+    ./benchmark.py run                      # no network needed
+    ./benchmark.py run --compare=chefdata/benchmarks/<previous>.json
+
+When no recorded fixtures exist, `run` generates a synthetic set of books.
+"""
+
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+import chef
+from ricecooker.utils.html import WebDriver
+
+
+CHEF_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(chef.CHEFDATA_DIR, 'benchmark_fixtures')
+RESULTS_DIR = os.path.join(chef.CHEFDATA_DIR, 'benchmarks')
+REPEATS = 5
+
+
+# FIXTURES
+################################################################################
+# A fixtures directory contains:
+#   catalog.html            snapshot of the READ page with all .story-cover items
+#   stories/<book_id>.html  page source of each story, as seen by `load_story`
+#   site/<host>/<path>      every static asset, by the URL it was fetched from
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter that saves every successful response under `site_dir`.
+    """
+    def __init__(self, site_dir, *args, **kwargs):
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+        self.site_dir = site_dir
+
+    def send(self, request, **kwargs):
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        if response.status_code == 200:
+            path = site_path(self.site_dir, request.url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(response.content)
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends every request to the local fixtures server.
+    """
+    def __init__(self, server_url, *args, **kwargs):
+        super(ReplayAdapter, self).__init__(*args, **kwargs)
+        self.server_url = server_url
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = '%s/%s%s' % (self.server_url, url.netloc, url.path)
+        return super(ReplayAdapter, self).send(request, **kwargs)
+
+
+def site_path(site_dir, url):
+    url = urlparse(url)
+    path = url.path.lstrip('/') or 'index.html'
+    return os.path.join(site_dir, url.netloc, path)
+
+
+def mount_on_chef_session(adapter):
+    for prefix in list(chef.sess.adapters) + ['http://', 'https://']:
+        chef.sess.mount(prefix, adapter)
+
+
+def record(fixtures_dir, books):
+    """
+    Record the catalog, the first `books` stories and all their assets.
+    """
+    site_dir = os.path.join(fixtures_dir, 'site')
+    os.makedirs(os.path.join(fixtures_dir, 'stories'), exist_ok=True)
+    mount_on_chef_session(RecordingAdapter(site_dir))
+    chef.asset_store = chef.AssetStore(tempfile.mkdtemp())
+    with WebDriver("http://3asafeer.com/", delay=0) as driver:
+        chef.click_read_and_wait(driver)
+        catalog = driver.page_source
+        with open(os.path.join(fixtures_dir, 'catalog.html'), 'w') as f:
+            f.write(catalog)
+        for book_info in chef.parse_book_infos(catalog)[:books]:
+            page_source = chef.load_story(driver, book_info['book_id'])
+            with open(os.path.join(fixtures_dir, 'stories', '%s.html' % book_info['book_id']), 'w') as f:
+                f.write(page_source)
+            chef.download_static_assets(BeautifulSoup(page_source, chef.HTML_PARSER),
+                                        chef.BookDirectory(tempfile.mkdtemp()))
+    print('Recorded %s stories to %s' % (books, fixtures_dir))
+
+
+def make_synthetic_fixtures(fixtures_dir, books=5, slides=16, seed=0):
+    """
+    Generate fixtures that look like the recorded ones, for machines that have
+    never had access to the website.
+    """
+    rng = random.Random(seed)
+    site_dir = os.path.join(fixtures_dir, 'site')
+
+    def write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content.encode('utf-8') if isinstance(content, str) else content)
+
+    def asset(url, size):
+        write(site_path(site_dir, url), rng.randbytes(size))
+
+    ui_images = ['ui/btn-%s.png' % i for i in range(20)]
+    for image in ui_images:
+        asset('http://3asafeer.com/images/%s' % image, 4000)
+    asset('http://fonts.gstatic.com/s/amiri/v1/amiri-regular.woff', 150000)
+    write(site_path(site_dir, 'http://3asafeer.com/scripts/jquery.min.js'),
+          'var jQuery=function(){return this};' * 2500)
+    write(site_path(site_dir, 'http://3asafeer.com/css/app.css'), ''.join(
+        '.c%s { background: url(../images/%s) no-repeat; }\n' % (i, image)
+        for i, image in enumerate(ui_images)
+    ) + "@font-face { font-family: Amiri; src: url(//fonts.gstatic.com/s/amiri/v1/amiri-regular.woff); }\n" * 2)
+    write(site_path(site_dir, 'http://fonts.googleapis.com/css'),
+          "@font-face { font-family: Amiri; src: url(http://fonts.gstatic.com/s/amiri/v1/amiri-regular.woff); }\n")
+    write(site_path(site_dir, 'http://3asafeer.com/scripts/app.js'), ''.join(
+        "function f%s() { $('.b').css('background', 'url(images/%s)'); localStorage.x = document.cookie; }\n"
+        % (i, image) for i, image in enumerate(ui_images)) * 20)
+
+    catalog = []
+    for book_id in range(1, books + 1):
+        catalog.append(
+            '<div class="story-cover" storyid="%s"><picture class="cover">'
+            '<img class="noimage" src="/images/covers/%s.jpg"></picture>'
+            '<div class="cover-title">قصة رقم %s</div><div class="rating-icon"> ج </div></div>'
+            % (book_id, book_id, book_id))
+        asset('http://3asafeer.com/images/covers/%s.jpg' % book_id, 20000)
+        slide_markup = []
+        for slide in range(slides):
+            image_url = 'http://3asafeer.com/images/stories/%s/%s.jpg' % (book_id, slide)
+            audio_url = 'http://3asafeer.com/audio/stories/%s/%s.mp3' % (book_id, slide)
+            asset(image_url, 60000)
+            asset(audio_url, 120000)
+            slide_markup.append(
+                '<div class="slide"><img src="%s"><p>كان يا ما كان في قديم الزمان %s</p>'
+                '<audio><source src="%s" type="audio/mpeg"></audio></div>'
+                % (urlparse(image_url).path, slide, urlparse(audio_url).path))
+        write(os.path.join(fixtures_dir, 'stories', '%s.html' % book_id), STORY_TEMPLATE % dict(
+            slides=''.join(slide_markup)))
+    write(os.path.join(fixtures_dir, 'catalog.html'),
+          '<html><body><div id="stories-container">%s</div></body></html>' % ''.join(catalog))
+
+
+STORY_TEMPLATE = """<html><head><base href="http://3asafeer.com/">
+<link rel="preconnect" href="//fonts.gstatic.com">
+<link rel="stylesheet" href="/css/app.min.css">
+<link rel="stylesheet" href="//fonts.googleapis.com/css?family=Amiri">
+<script src="/scripts/jquery.min.js"></script>
+<script src="/scripts/app.js"></script>
+<script src="//www.google-analytics.com/analytics.js"></script>
+<script>(function(i,s,o,g,r,a,m){i['GoogleAnalyticsObject']=r;})(window);</script>
+<style>.reader { background: url(/images/ui/btn-1.png); }</style>
+</head><body>
+<div id="loading"></div><div id="androidNotification"></div><div id="ttmenu"></div>
+<!-- FB SDK Code Start --><div id="fb-root"></div><script>FB.init();</script><!-- FB SDK Code End -->
+<div id="maincontent"><div id="reader-viewport"><div class="bookmarkbtn"></div>
+<div id="slide-container">%(slides)s</div><div id="progressBar"></div></div></div>
+<script>var a = 'images/ui/btn-2.png'; localStorage.audio = 1;</script>
+<script>$.get('refresh_session.php');</script>
+</body></html>
+"""
+
+
+# LOCAL SERVER
+################################################################################
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve_fixtures(fixtures_dir):
+    """
+    Serve `fixtures_dir/site` on a free local port and point the chef's HTTP
+    session at it.
+    """
+    handler = partial(FixtureRequestHandler, directory=os.path.join(fixtures_dir, 'site'))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    saved_adapters = dict(chef.sess.adapters)
+    mount_on_chef_session(ReplayAdapter('http://127.0.0.1:%s' % server.server_port))
+    try:
+        yield
+    finally:
+        chef.sess.adapters.clear()
+        chef.sess.adapters.update(saved_adapters)
+        server.shutdown()
+
+
+# STAGES
+################################################################################
+
+def timed(fn, repeats=REPEATS, setup=None):
+    """
+    Run `fn(setup())` `repeats` times and return the durations in seconds.
+    The chef's own output is swallowed so it doesn't distort the timings.
+    """
+    durations = []
+    for _ in range(repeats):
+        arg = setup() if setup else None
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn(arg)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_benchmarks(fixtures_dir, repeats=REPEATS):
+    with open(os.path.join(fixtures_dir, 'catalog.html')) as f:
+        catalog = f.read()
+    story_sources = []
+    for filename in sorted(os.listdir(os.path.join(fixtures_dir, 'stories'))):
+        with open(os.path.join(fixtures_dir, 'stories', filename)) as f:
+            story_sources.append(f.read())
+
+    def parse(source):
+        return BeautifulSoup(source, chef.HTML_PARSER)
+
+    def fresh_store():
+        chef.asset_store = chef.AssetStore(tempfile.mkdtemp(dir=scratch_dir))
+
+    def new_book(i):
+        return chef.BookZip(os.path.join(scratch_dir, 'book-%s.zip' % i))
+
+    def download_all_assets(_):
+        for i, source in enumerate(story_sources):
+            chef.download_static_assets(parse(source), new_book(i))
+
+    def prepare_books():
+        books = []
+        with redirect_stdout(io.StringIO()):
+            for i, source in enumerate(story_sources):
+                book = new_book(i)
+                doc, _ = chef.download_static_assets(parse(source), book)
+                book.add_bytes('index.html', str(doc).encode('utf-8'))
+                books.append(book)
+        return books
+
+    def cleanup_all(docs):
+        for doc in docs:
+            chef.cleanup_rules.apply(doc)
+
+    def run_middlewares(contents):
+        for middleware, content in contents:
+            middleware(content, url='', deps=[])
+
+    def zip_all(books):
+        for book in books:
+            os.remove(book.close())
+
+    scratch_dir = tempfile.mkdtemp()
+    try:
+        with serve_fixtures(fixtures_dir):
+            stages = {}
+            stages['get_book_infos_parse'] = timed(
+                lambda _: chef.parse_book_infos(catalog), repeats)
+            stages['story_parse'] = timed(
+                lambda _: [parse(source) for source in story_sources], repeats)
+            stages['process_node_cleanup'] = timed(
+                cleanup_all, repeats, setup=lambda: [parse(source) for source in story_sources])
+            stages['download_static_assets_cold'] = timed(
+                download_all_assets, repeats, setup=fresh_store)
+            stages['download_static_assets_warm'] = timed(download_all_assets, repeats)
+
+            # The middlewares on the site's CSS and JS, with their nested
+            # downloads already in the (warm) asset store
+            site_dir = os.path.join(fixtures_dir, 'site')
+            contents = []
+            for root, _, filenames in os.walk(site_dir):
+                for filename in sorted(filenames):
+                    middleware = {'.css': chef.css_content_middleware,
+                                  '.js': chef.js_middleware}.get(os.path.splitext(filename)[1])
+                    if middleware:
+                        with open(os.path.join(root, filename), errors='replace') as f:
+                            contents.append((middleware, f.read()))
+            stages['middlewares'] = timed(run_middlewares, repeats, setup=lambda: contents)
+            stages['write_book_zip'] = timed(zip_all, repeats, setup=prepare_books)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return dict(
+        version=git_version(),
+        created_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        html_parser=chef.HTML_PARSER,
+        books=len(story_sources),
+        repeats=repeats,
+        stages={name: summarize(durations) for name, durations in stages.items()},
+    )
+
+
+def summarize(durations):
+    return dict(
+        min=min(durations),
+        median=statistics.median(durations),
+        mean=statistics.mean(durations),
+        max=max(durations),
+    )
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=CHEF_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    print('%-32s %10s %10s' % ('stage', 'median s', 'vs prev'))
+    for name, stats in results['stages'].items():
+        change = ''
+        if previous and name in previous['stages']:
+            change = '%+.0f%%' % (100.0 * (stats['median'] / previous['stages'][name]['median'] - 1))
+        print('%-32s %10.4f %10s' % (name, stats['median'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='Record fixtures from the live website.')
+    record_parser.add_argument('--books', type=int, default=5)
+    record_parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks against recorded fixtures.')
+    run_parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    run_parser.add_argument('--repeats', type=int, default=REPEATS)
+    run_parser.add_argument('--output', help='Where to write the JSON results.')
+    run_parser.add_argument('--compare', help='Previous JSON results to compare against.')
+    args = parser.parse_args()
+
+    os.chdir(CHEF_DIR)          # the chef copies static/ relative to its directory
+    if args.command == 'record':
+        record(args.fixtures, args.books)
+        return
+
+    if not os.path.exists(os.path.join(args.fixtures, 'catalog.html')):
+        print('No recorded fixtures in %s, generating synthetic ones' % args.fixtures)
+        make_synthetic_fixtures(args.fixtures)
+    results = run_benchmarks(args.fixtures, args.repeats)
+    output = args.output or os.path.join(
+        RESULTS_DIR, 'benchmark-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    print('Wrote', output)
+
+
+if __name__ == '__main__':
+    main()
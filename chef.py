@@ -5,31 +5,78 @@ Sushi Chef for http://3asafeer.com/
 We make an HTML5 app out of each interactive reader.
 """
 
-from collections import OrderedDict
+import argparse
+from collections import Counter, defaultdict, namedtuple, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import gc
+import hashlib
 import html
+import io
+import json
 import os
+import queue
+import random
 import re
 import requests
 import shutil
+import subprocess
+import sqlite3
 import sys
 import tempfile
+import threading
 import time
-from urllib.parse import urlparse, parse_qs
-import uuid
-
-from bs4 import BeautifulSoup, Comment
-
+from urllib.parse import urlparse, parse_qs, quote
+import zipfile
+
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
+import soupsieve
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None                    # no Unix file locks (Windows): shards can't share a manifest
+
+try:
+    import resource
+except ImportError:
+    resource = None                 # no getrusage (Windows): memory use isn't measured
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None                    # image optimization is unavailable without Pillow
+
+try:
+    from fontTools import subset as font_subset
+except ImportError:
+    font_subset = None              # font subsetting is unavailable without fontTools
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None                  # CSS is not minified without rcssmin
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None                   # JS is not minified without rjsmin
 
 import le_utils.constants
+from ricecooker import config
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, licenses
-from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter, InvalidatingCacheControlAdapter
-from cachecontrol.heuristics import ExpiresAfter
 from ricecooker.utils.browser import preview_in_browser
-from ricecooker.utils.html import download_file, WebDriver
-from ricecooker.utils.zip import create_predictable_zip
+from ricecooker.utils.html import WebDriver
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
 import selenium.webdriver.support.ui as selenium_ui
-from distutils.dir_util import copy_tree
 
 
 
@@ -38,14 +85,25 @@ from distutils.dir_util import copy_tree
 DEBUG_MODE = False                    # print extra-verbose info
 DOWNLOAD_ONE_TO_webroot = False       # produce debug webroot/ and skip cheffing
 DOWNLOAD_ONLY_N = False               # chef only first N books; set to False to disable
+HTML_PARSER = 'html.parser'           # BeautifulSoup parser; 'lxml' is much faster if installed
 
 
-
-sess = requests.Session()
-cache = FileCache('.webcache')
-chefdev_adapter = CacheControlAdapter(heuristic=ExpiresAfter(days=1), cache=cache)
-sess.mount('http://3asafeer.com/', chefdev_adapter)
-sess.mount('http://fonts.googleapis.com/', chefdev_adapter)
+# CHEF DATA
+################################################################################
+CHEFDATA_DIR = 'chefdata'             # persistent data kept between chef runs
+ASSET_STORE_DIR = os.path.join(CHEFDATA_DIR, 'assets')   # content-addressed assets
+BUILD_MANIFEST_PATH = os.path.join(CHEFDATA_DIR, 'build_manifest.json')
+ZIPS_DIR = os.path.join(CHEFDATA_DIR, 'zips')           # book zips kept for reuse
+MANIFEST_MAX_AGE_DAYS = 30            # re-render unchanged books after this long
+CATALOG_PATH = os.path.join(CHEFDATA_DIR, 'catalog.json')   # last good catalog
+CATALOG_MAX_AGE_HOURS = 24            # reuse the saved catalog while it is this fresh
+RUN_REPORT_PATH = os.path.join(CHEFDATA_DIR, 'run_report.json')   # timings of the last run
+SHARDS_DIR = os.path.join(CHEFDATA_DIR, 'shards')       # book lists written by --shard runs
+ASSET_WORKERS = 8                     # concurrent asset downloads per batch
+ASSET_HOST_CONCURRENCY = 6            # concurrent requests per host, across all books
+HTTP_CACHE_PATH = os.path.join(CHEFDATA_DIR, 'webcache.sqlite')  # responses from the site
+HTTP_CACHE_MAX_MB = 2048              # least recently used responses are evicted above this
+HTTP_CACHE_FRESH_HOURS = 24           # after this, cached responses are revalidated
 
 
 headers = {
@@ -54,11 +112,94 @@ headers = {
     "Connection": "keep-alive"
 }
 
-# PAUSES and DELAYS
+# REQUEST SCHEDULING
+################################################################################
+HOST_RATE_LIMITS = {                      # host -> (requests per second, burst)
+    '3asafeer.com': (8, 16),
+    'fonts.googleapis.com': (10, 20),
+    'fonts.gstatic.com': (10, 20),
+}
+DEFAULT_RATE_LIMIT = (10, 20)             # for hosts not listed above
+MIN_RATE = 0.5                            # throttled hosts never go slower than this
+MAX_RETRIES = 5                           # attempts after the first one
+BACKOFF_BASE = 1                          # seconds; doubles on every retry, with jitter
+BACKOFF_MAX = 60                          # longest wait between retries, and Retry-After cap
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CIRCUIT_FAILURES = 10                     # consecutive failures before a host is skipped
+CIRCUIT_COOLDOWN = 120                    # seconds before a skipped host is tried again
+
+
+# READINESS WAITS
+################################################################################
+WAIT_POLL_INTERVAL = 0.25                 # seconds between readiness checks
+WAIT_TIMEOUTS = {                         # seconds before giving up on a condition
+    'document_ready': 60,
+    'popup_visible': 30,
+    'popup_closed': 15,
+    'stories_container': 60,
+    'no_pending_xhr': 30,
+    'story_count_stable': 30,
+    'reader_viewport': 30,
+    'slide_images_loaded': 60,
+}
+STORY_COUNT_SETTLE_POLLS = 4              # polls without growth before the catalog is complete
+
+
+# PARALLEL RENDERING
+################################################################################
+BROWSER = 'phantomjs'           # 'phantomjs', or headless 'chromium' or 'firefox'
+BROWSER_SESSIONS = 4            # number of long-lived browser sessions in the pool
+BOOK_ATTEMPTS = 2               # tries per book; each retry gets a fresh session
+BOOK_WORKERS = 8                # books processed concurrently (browser or not)
+ZIP_WORKERS = 2                 # threads writing and hashing book zips
+PRESTAGE_WORKERS = 2            # threads copying finished books into ricecooker's storage
+PIPELINE_QUEUE_SIZE = 8         # books waiting between stages before the previous one blocks
+
+
+# STORY FETCHING
+################################################################################
+STORY_FETCH_MODE = 'http'       # 'http': fetch stories directly, browser as fallback
+                                # 'browser': always render stories in the --browser backend
+# The fragment that the site's `getPage(page, type, id)` loads into #maincontent
+GETPAGE_URL = "http://3asafeer.com/pages/{page}.php?type={type}&id={id}"
+CATALOG_FETCH_MODE = 'http'     # 'http': page through CATALOG_PAGE_URL, browser as fallback
+                                # 'browser': scroll the READ page with loadMoreData()
+# The paginated fragment of `.story-cover` items that `window.loadMoreData()` appends
+CATALOG_PAGE_URL = "http://3asafeer.com/pages/loadMoreData.php?type=story&page={page}"
+CATALOG_TOTAL_SELECTOR = '[data-total]'   # element whose data-total is the site's story count
+CATALOG_WORKERS = 4             # catalog pages fetched concurrently
+CATALOG_MAX_PAGES = 500         # give up on the HTTP catalog beyond this many pages
+IN_SESSION_NAVIGATION = True    # go from story to story without reloading the homepage
+IN_SESSION_PROBE_BOOKS = 3      # stop trying if this many stories fail the check at first
+
+
+# MEMORY
+################################################################################
+LOW_MEMORY = False              # free each book's data as soon as its zip is written
+LOW_MEMORY_SESSION_BOOKS = 10   # in low-memory mode, restart browser sessions this often
+MAX_RSS_MB = None               # memory budget (chef + browsers); None for no budget
+
+
+# MEDIA OPTIMIZATION
 ################################################################################
-LOADING_WAIT_TIME = 10                                             # long delay
-LOADING_WAIT_TIME_MS = LOADING_WAIT_TIME*1000
-LOADING_WAIT_TIME_SHORT = 7                                        # short delay
+OPTIMIZE_IMAGES = False         # resize and recompress slide images (needs Pillow)
+MEDIA_DIR = os.path.join(CHEFDATA_DIR, 'media')   # optimized images, by source hash
+IMAGE_MAX_DIMENSION = 1280      # longest side of an optimized image, in pixels
+JPEG_QUALITY = 80               # quality of recompressed JPEG images
+TRANSCODE_AUDIO = None          # codec for read-aloud audio (needs ffmpeg); None keeps it as is
+AUDIO_BITRATE = '32k'           # bitrate of transcoded audio; plenty for a mono voice
+AUDIO_FALLBACK = True           # keep the original as a fallback <source> for codecs not every
+                                # target browser plays (opus); mp3 and aac never need one
+LAZY_SLIDES = False             # load slide images and audio only when a slide comes up
+LAZY_EAGER_SLIDES = 2           # slides loaded up front in lazy mode: the first and the next
+SUBSET_FONTS = None             # 'book' or 'channel': keep only the glyphs used (needs fontTools)
+MINIFY = False                  # minify the HTML, CSS (needs rcssmin) and JS (needs rjsmin)
+STRIP_UNUSED_CSS = False        # drop CSS rules for classes and ids that no book markup or JS has
+# Characters kept in every subset font, whatever the text: ASCII, Arabic digits and punctuation
+FONT_EXTRA_CHARS = (''.join(map(chr, range(0x20, 0x7f)))             # printable ASCII
+                    + ''.join(map(chr, range(0x0660, 0x066d)))      # Arabic-Indic digits, separators
+                    + '\u060c\u061b\u061f\u0640'                       # Arabic comma, semicolon, ?, tatweel
+                    + '\u00a0\u200c\u200d\u200e\u200f')                # nbsp, joiners, direction marks
 
 
 class ThreeAsafeerChef(SushiChef):
@@ -67,6 +208,60 @@ class ThreeAsafeerChef(SushiChef):
 
     We'll call its `main()` method from the command line script.
     """
+    def __init__(self, *args, **kwargs):
+        super(ThreeAsafeerChef, self).__init__(*args, **kwargs)
+        self.arg_parser.add_argument('--browser', choices=['phantomjs', 'chromium', 'firefox'],
+            default=BROWSER,
+            help='Browser used to render pages; chromium and firefox run headless and '
+                 'block analytics, fonts and media.')
+        self.arg_parser.add_argument('--sessions', type=positive_int, default=BROWSER_SESSIONS,
+            help='Number of browser sessions used to render books in parallel.')
+        self.arg_parser.add_argument('--workers', type=positive_int, default=BOOK_WORKERS,
+            help='Number of books processed concurrently.')
+        self.arg_parser.add_argument('--fetch-mode', choices=['http', 'browser'],
+            default=STORY_FETCH_MODE,
+            help='Fetch story pages over HTTP (with browser fallback) or always use the browser.')
+        self.arg_parser.add_argument('--rebuild', action='store_true',
+            help='Ignore the build manifest and rebuild every book from scratch.')
+        self.arg_parser.add_argument('--refresh-catalog', action='store_true',
+            help='Load the list of books from the website even if a recent saved catalog exists.')
+        self.arg_parser.add_argument('--catalog-mode', choices=['http', 'browser'],
+            default=CATALOG_FETCH_MODE,
+            help='Page through the catalog over HTTP (with browser fallback) or scroll the READ page.')
+        self.arg_parser.add_argument('--shard', type=parse_shard,
+            help='Only build shard I of N of the catalog (e.g. 3/8) and save its book list '
+                 'for --merge-shards, without uploading.')
+        self.arg_parser.add_argument('--merge-shards', type=int, metavar='N',
+            help='Build the channel from the book lists of all N shards instead of scraping.')
+        self.arg_parser.add_argument('--low-memory', action='store_true', default=LOW_MEMORY,
+            help='Free each book as soon as its zip is written and restart browser sessions '
+                 'every %s books.' % LOW_MEMORY_SESSION_BOOKS)
+        self.arg_parser.add_argument('--max-rss-mb', type=int, default=MAX_RSS_MB,
+            help='Memory budget in MB for the chef and its browsers; books are processed one '
+                 'at a time while it is exceeded.')
+        self.arg_parser.add_argument('--optimize-images', action='store_true',
+            default=OPTIMIZE_IMAGES,
+            help='Resize and recompress images to make the book zips smaller.')
+        self.arg_parser.add_argument('--image-max-dimension', type=int,
+            default=IMAGE_MAX_DIMENSION,
+            help='Longest side, in pixels, of images resized by --optimize-images.')
+        self.arg_parser.add_argument('--transcode-audio', choices=sorted(AudioTranscoder.codecs),
+            default=TRANSCODE_AUDIO,
+            help='Transcode the read-aloud audio to this codec with ffmpeg.')
+        self.arg_parser.add_argument('--audio-bitrate', default=AUDIO_BITRATE,
+            help='Bitrate of audio transcoded by --transcode-audio, e.g. 32k.')
+        self.arg_parser.add_argument('--subset-fonts', choices=['book', 'channel'],
+            default=SUBSET_FONTS,
+            help='Subset web fonts to the characters used by each book, or by the whole channel.')
+        self.arg_parser.add_argument('--minify', action='store_true', default=MINIFY,
+            help='Minify the HTML, CSS and JS of the books once all rewrites are done.')
+        self.arg_parser.add_argument('--strip-unused-css', action='store_true',
+            default=STRIP_UNUSED_CSS,
+            help='With --minify, also drop CSS rules whose classes or ids the book never uses.')
+        self.arg_parser.add_argument('--lazy-slides', action='store_true',
+            default=LAZY_SLIDES,
+            help='Make the reader load slide images and audio as the slides come up.')
+
     channel_info = {
         'CHANNEL_SOURCE_DOMAIN': "3asafeer.com",
         'CHANNEL_SOURCE_ID': "3asafeer",
@@ -90,7 +285,41 @@ class ThreeAsafeerChef(SushiChef):
             language = "ar",
         )
 
-        download_all(channel)
+        memory_budget.configure(kwargs.get('low_memory', LOW_MEMORY),
+                                kwargs.get('max_rss_mb', MAX_RSS_MB))
+        if kwargs.get('optimize_images', OPTIMIZE_IMAGES):
+            image_optimizer.enable(kwargs.get('image_max_dimension', IMAGE_MAX_DIMENSION),
+                                   JPEG_QUALITY)
+        if kwargs.get('transcode_audio', TRANSCODE_AUDIO):
+            audio_transcoder.enable(kwargs['transcode_audio'],
+                                    kwargs.get('audio_bitrate', AUDIO_BITRATE), AUDIO_FALLBACK)
+        if kwargs.get('lazy_slides', LAZY_SLIDES):
+            lazy_slides.enable(LAZY_EAGER_SLIDES)
+        if kwargs.get('subset_fonts', SUBSET_FONTS):
+            font_subsetter.enable(kwargs['subset_fonts'])
+        if kwargs.get('minify', MINIFY):
+            minifier.enable(kwargs.get('strip_unused_css', STRIP_UNUSED_CSS))
+        if kwargs.get('merge_shards'):
+            records = load_shards(kwargs['merge_shards'])
+            pipeline = BookPipeline()
+            try:
+                records = pipeline.wait(records)
+            finally:
+                pipeline.close()
+            build_topic_tree(channel, [record for record in records if record is not None])
+            return channel
+        download_all(channel,
+                     browser=kwargs.get('browser', BROWSER),
+                     sessions=kwargs.get('sessions', BROWSER_SESSIONS),
+                     workers=kwargs.get('workers', BOOK_WORKERS),
+                     fetch_mode=kwargs.get('fetch_mode', STORY_FETCH_MODE),
+                     rebuild=kwargs.get('rebuild', False),
+                     refresh_catalog=kwargs.get('refresh_catalog', False),
+                     catalog_mode=kwargs.get('catalog_mode', CATALOG_FETCH_MODE),
+                     shard=kwargs.get('shard'))
+        if kwargs.get('shard'):
+            print('Skipping chef upload -- run with --merge-shards once all shards are done.')
+            sys.exit(0)
         if DOWNLOAD_ONE_TO_webroot:
             print('Skipping chef upload -- check webroot/ folder for sample book.')
             sys.exit(0)
@@ -164,33 +393,74 @@ RATING_TOPIC_MAP = {
 }
 
 
-def download_all(channel):
+def download_all(channel, browser=BROWSER, sessions=BROWSER_SESSIONS, workers=BOOK_WORKERS,
+                 fetch_mode=STORY_FETCH_MODE, rebuild=False, refresh_catalog=False,
+                 catalog_mode=CATALOG_FETCH_MODE, shard=None):
     if DEBUG_MODE:
         print("In download_all")
     # books_count = get_books_count()
-    book_infos = get_book_infos()
+    book_infos = get_book_infos(refresh=refresh_catalog, browser=browser,
+                                catalog_mode=catalog_mode)
     if DOWNLOAD_ONLY_N:
         print("Scraping first %s books for testing out of total of %s books available." % (DOWNLOAD_ONLY_N, len(book_infos)))
         book_infos = book_infos[0:DOWNLOAD_ONLY_N]
     else:
         print("There are %s books ... scraping them now!" % len(book_infos))
+    if DOWNLOAD_ONE_TO_webroot:
+        print('Processing just one book because DOWNLOAD_ONE_TO_webroot is set')
+        book_infos = book_infos[0:1]
+        sessions = workers = 1
+    if fetch_mode == 'browser':
+        workers = sessions
+    catalog_fingerprint = fingerprint(json.dumps(book_infos, sort_keys=True))
+    indexes = list(range(len(book_infos)))
+    report_path = RUN_REPORT_PATH
+    if shard:
+        # Every N-th book, so the shards get a similar mix of old and new books
+        indexes = indexes[shard[0] - 1::shard[1]]
+        print('Shard %s/%s: %s of the %s books' % (shard[0], shard[1], len(indexes), len(book_infos)))
+        report_path = os.path.join(SHARDS_DIR, 'run_report-%s-of-%s.json' % shard)
+
+    # Render the books in parallel; `map` hands back the results in catalog
+    # order no matter which worker finishes first.
+    # The finished books go through a pipeline, which writes their zips and
+    # copies them into ricecooker's storage while later books are rendered.
+    runtime_bundle.build()
+    pool = DriverPool(sessions, browser=browser,
+                      max_uses=LOW_MEMORY_SESSION_BOOKS if memory_budget.low_memory else None)
+    pipeline = BookPipeline(prestage=not shard and not DOWNLOAD_ONE_TO_webroot)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda i: render_book(pool, pipeline, i, len(book_infos), book_infos[i],
+                                      fetch_mode=fetch_mode, rebuild=rebuild),
+                indexes))
+        results = pipeline.wait(results)
+    finally:
+        pool.close()
+        pipeline.close()
+    print_wait_timings()
+    run_stats.write_report(report_path)
+
+    if shard:
+        save_shard(shard, catalog_fingerprint, zip(indexes, results))
+    else:
+        build_topic_tree(channel, [record for record in results if record is not None])
 
+
+def build_topic_tree(channel, records):
+    """
+    Add the level topics to `channel`, with a subtopic per rating holding the
+    books in `records` (`BookRecord`s), in the order given.
+    """
     topic_nodes = OrderedDict()
     channel.add_child(novice_topic)
     channel.add_child(intermediate_topic)
     channel.add_child(advanced_topic)
 
-    source_ids_seen = []
-    for i, book_info in enumerate(book_infos):
-        print('-' * 80)
-        if DOWNLOAD_ONE_TO_webroot and i > 0:
-            print('Processing just one book because DOWNLOAD_ONE_TO_webroot is set')
-            return
-        print('Downloading book %s of %s' % (i + 1, len(book_infos)))
-        book, rating = download_book(book_info['book_id'],
-                                     book_info['title'],
-                                     book_info['thumbnail'],
-                                     book_info['rating_text'])
+    source_ids_seen = set()
+    for record in records:
+        rating = record.rating
 
         if not topic_nodes.get(rating):
             title = RATING_NUM_MAP.get(rating, rating)
@@ -207,13 +477,449 @@ def download_all(channel):
 
             print("creating topic node %s with title %s" % (topic_nodes[rating], title))
         
-        source_id = book.source_id
+        source_id = record.book_id
         if source_id not in source_ids_seen:
-            topic_nodes[rating].add_child(book)
-            source_ids_seen.append(book.source_id)
+            topic_nodes[rating].add_child(make_book_node(record))
+            source_ids_seen.add(source_id)
+        else:
+            print('found duplicate of book.source_id', source_id, record.title)
+
+
+def positive_int(value):
+    """
+    Parse a count argument like `--workers N`, which must be at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a whole number, got %r' % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got %s' % number)
+    return number
+
+
+# SHARDS
+################################################################################
+
+def parse_shard(value):
+    """
+    Parse `--shard I/N` into `(I, N)`, with shards numbered from 1.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected I/N, e.g. 3/8')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard %s is not between 1 and %s' % (index, count))
+    return index, count
+
+
+def shard_path(index, count):
+    return os.path.join(SHARDS_DIR, 'shard-%s-of-%s.json' % (index, count))
+
+
+def save_shard(shard, catalog_fingerprint, results):
+    """
+    Save the `BookRecord`s built by this shard, with their catalog positions,
+    for `load_shards`. Failed books (`None` results) are listed as failed.
+    """
+    books, failed = [], []
+    for index, record in results:
+        if record is None:
+            failed.append(index)
+        else:
+            books.append(dict(record._asdict(), index=index))
+    path = shard_path(*shard)
+    atomic_write(path, json.dumps(dict(shard=list(shard), catalog=catalog_fingerprint,
+                                       books=books, failed=failed), indent=2, ensure_ascii=False))
+    print('Saved %s books (%s failed) of shard %s/%s to %s' % (
+        len(books), len(failed), shard[0], shard[1], path))
+
+
+def load_shards(count):
+    """
+    Return the `BookRecord`s of all `count` shards in catalog order, checking
+    that every shard finished, worked from the same catalog, and that all the
+    book zips are here (copy chefdata/zips over from other machines).
+    """
+    shards = []
+    for index in range(1, count + 1):
+        path = shard_path(index, count)
+        if not os.path.exists(path):
+            sys.exit('Shard %s/%s is missing: %s not found' % (index, count, path))
+        with open(path) as f:
+            shards.append(json.load(f))
+    if len(set(shard['catalog'] for shard in shards)) > 1:
+        sys.exit('The shards were built from different catalogs; '
+                 'copy chefdata/catalog.json to every machine and rerun them')
+    books = sorted((book for shard in shards for book in shard['books']),
+                   key=lambda book: book['index'])
+    missing = [book['zip_path'] for book in books if not os.path.exists(book['zip_path'])]
+    if missing:
+        sys.exit('%s book zips are missing, e.g. %s' % (len(missing), missing[0]))
+    failed = sum(len(shard['failed']) for shard in shards)
+    print('Merging %s books from %s shards (%s books failed)' % (len(books), count, failed))
+    return [BookRecord(*(book[field] for field in BookRecord._fields)) for book in books]
+
+
+def render_book(pool, pipeline, i, total, book_info, fetch_mode=STORY_FETCH_MODE,
+                rebuild=False):
+    """
+    Download one book, over plain HTTP when `fetch_mode` is 'http' and on a
+    pooled browser session otherwise or when the direct fetch doesn't validate.
+    Returns the book's `BookRecord`, or a `Future` of it while its zip is being
+    written by the `pipeline`, or `None` if the book failed on every attempt so
+    the rest of the run goes on. Books whose story is unchanged since the last
+    run reuse their zip, see `build_book`; in 'browser' mode, where checking
+    that takes a browser session, an unchanged catalog entry is enough.
+    """
+    with run_stats.book(book_info['book_id']), memory_budget.book_slot(pool):
+        return _render_book(pool, pipeline, i, total, book_info, fetch_mode, rebuild)
+
+
+def _render_book(pool, pipeline, i, total, book_info, fetch_mode, rebuild):
+    book_id = book_info['book_id']
+    catalog_fingerprint = fingerprint(json.dumps(book_info, sort_keys=True))
+    # Over HTTP, checking the story itself is cheap: leave it to `build_book`
+    entry = None if rebuild or fetch_mode == 'http' else build_manifest.reusable_entry(
+        book_id, max_age_days=MANIFEST_MAX_AGE_DAYS, catalog=catalog_fingerprint,
+        media=media_settings(), runtime=runtime_bundle.digest)
+    if entry:
+        print('Book %s of %s (%s) is unchanged, reusing %s' % (
+            i + 1, total, book_id, entry['zip_path']))
+        run_stats.set_status('reused')
+        record = BookRecord(book_id, book_info['title'], entry['thumbnail'], entry['zip_path'],
+                            book_info['rating_text'])
+        pipeline.queue_prestage(record)
+        return record
+
+    for attempt in range(1, BOOK_ATTEMPTS + 1):
+        print('-' * 80)
+        print('Downloading book %s of %s (attempt %s)' % (i + 1, total, attempt))
+        try:
+            result = None
+            if fetch_mode == 'http' and attempt == 1:
+                result = fetch_book(book_id,
+                                    book_info['title'],
+                                    book_info['thumbnail'],
+                                    book_info['rating_text'],
+                                    rebuild=rebuild)
+            if result is None:
+                result = download_book(pool,
+                                       book_id,
+                                       book_info['title'],
+                                       book_info['thumbnail'],
+                                       book_info['rating_text'],
+                                       rebuild=rebuild)
+            run_stats.set_status('built')
+            if isinstance(result, PendingBook):
+                # Hand the zip over to the pipeline and move on to the next book
+                return pipeline.finish(result, catalog=catalog_fingerprint)
+            if not DOWNLOAD_ONE_TO_webroot:
+                build_manifest.record(book_id, catalog=catalog_fingerprint,
+                                      checked_at=time.time())
+            pipeline.queue_prestage(result)
+            return result
+        except Exception as e:
+            print('Failed to download book %s: %r' % (book_info['book_id'], e))
+            run_stats.count('failed_attempts')
+    print('Giving up on book', book_info['book_id'])
+    run_stats.set_status('failed')
+    return None
+
+
+class DriverPool(object):
+    """
+    A fixed number of long-lived browser sessions shared by the book workers.
+    Sessions are started lazily; a session that raised while rendering a book is
+    shut down and replaced by a fresh one the next time its slot is used, and so
+    is a session that has rendered `max_uses` books.
+    """
+    def __init__(self, size, url="http://3asafeer.com/", delay=0, max_uses=None,
+                 browser=BROWSER):
+        self.browser = browser
+        self.url = url
+        self.delay = delay
+        self.max_uses = max_uses
+        self._uses = {}                 # id(web_driver) -> books rendered
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    @contextmanager
+    def session(self):
+        web_driver = self._idle.get()
+        try:
+            if web_driver is None:
+                web_driver = make_web_driver(self.browser, self.url, delay=self.delay)
+                web_driver.__enter__()
+            yield web_driver.driver
+            self._uses[id(web_driver)] = self._uses.get(id(web_driver), 0) + 1
+            if self.max_uses and self._uses[id(web_driver)] >= self.max_uses:
+                self._quit(web_driver)
+                web_driver = None
+        except:
+            self._quit(web_driver)
+            web_driver = None
+            raise
+        finally:
+            self._idle.put(web_driver)
+
+    def release_idle(self):
+        """
+        Shut down the sessions nobody is using right now, to free memory.
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for web_driver in idle:
+            self._quit(web_driver)
+            self._idle.put(None)
+
+    def close(self):
+        while not self._idle.empty():
+            self._quit(self._idle.get())
+
+    def _quit(self, web_driver):
+        if web_driver is None or not hasattr(web_driver, 'driver'):
+            return
+        self._uses.pop(id(web_driver), None)
+        try:
+            web_driver.__exit__(None, None, None)
+        except Exception as e:
+            print('Error while closing browser session:', e)
+
+
+# BROWSER BACKENDS
+################################################################################
+
+# Requests that rendering doesn't need, on top of `url_blacklist`: web fonts
+# and the read-aloud audio (slide images are kept, we wait for them to load).
+BLOCKED_RESOURCE_PATTERNS = [
+    '*fonts.googleapis.com*', '*fonts.gstatic.com*',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp3', '*.m4a', '*.ogg', '*.wav', '*.mp4', '*.webm',
+]
+
+
+def blocked_url_patterns():
+    return ['*%s*' % item for item in url_blacklist] + BLOCKED_RESOURCE_PATTERNS
+
+
+def make_web_driver(browser, url, delay=0):
+    """
+    A context manager like ricecooker's `WebDriver` (which runs PhantomJS) for
+    the `browser` backend.
+    """
+    if browser == 'phantomjs':
+        return WebDriver(url, delay=delay)
+    return HeadlessBrowser(browser, url, delay=delay)
+
+
+class HeadlessBrowser(object):
+    """
+    Headless Chromium or Firefox session that blocks `blocked_url_patterns()`
+    at the network level, so that analytics, social widgets, fonts and audio
+    are never downloaded or run. Chromium uses the DevTools protocol's
+    `Network.setBlockedURLs`; Firefox sends blocked URLs, through a proxy
+    auto-config script, to a closed local port. The first session of each
+    backend checks that a blacklisted script really fails to load.
+    """
+    blocking_checked = set()            # backends whose blocking has been checked
+    _check_lock = threading.Lock()
+
+    def __init__(self, browser, url, delay=0):
+        self.browser = browser
+        self.url = url
+        self.delay = delay
+
+    def __enter__(self):
+        if self.browser == 'chromium':
+            self.driver = self._start_chromium()
+        else:
+            self.driver = self._start_firefox()
+        self.driver.get(self.url)
+        with self._check_lock:
+            if self.browser not in self.blocking_checked:
+                self.blocking_checked.add(self.browser)
+                self.check_blocking()
+        time.sleep(self.delay / 1000.0)
+        return self.driver
+
+    def check_blocking(self, url='https://www.google-analytics.com/analytics.js'):
+        self.driver.set_script_timeout(30)
+        try:
+            result = self.driver.execute_async_script(LOAD_SCRIPT_JS, url)
+        except WebDriverException as e:
+            result = 'unknown (%s)' % e
+        if result == 'blocked':
+            print('Request blocking works in %s' % self.browser)
+        else:
+            print('WARNING: %s loaded the blacklisted %s (%s); request blocking is '
+                  'not working' % (self.browser, url, result))
+
+    def __exit__(self, type, value, traceback):
+        self.driver.quit()
+
+    def _start_chromium(self):
+        options = webdriver.ChromeOptions()
+        for argument in ('--headless', '--disable-gpu', '--no-sandbox',
+                         '--disable-dev-shm-usage', '--mute-audio'):
+            options.add_argument(argument)
+        driver = webdriver.Chrome(chrome_options=options)
+        execute_cdp_cmd(driver, 'Network.enable', {})
+        execute_cdp_cmd(driver, 'Network.setBlockedURLs', {'urls': blocked_url_patterns()})
+        return driver
+
+    def _start_firefox(self):
+        pac = 'function FindProxyForURL(url, host) { %s return "DIRECT"; }' % ''.join(
+            'if (shExpMatch(url, %s)) return "PROXY 127.0.0.1:9";' % json.dumps(pattern)
+            for pattern in blocked_url_patterns())
+        profile = webdriver.FirefoxProfile()
+        profile.set_preference('network.proxy.type', 2)
+        profile.set_preference('network.proxy.autoconfig_url',
+                               'data:application/x-ns-proxy-autoconfig,' + quote(pac))
+        # Otherwise Firefox connects directly when the proxy fails, and nothing is blocked
+        profile.set_preference('network.proxy.failover_direct', False)
+        profile.set_preference('media.autoplay.default', 5)
+        options = FirefoxOptions()
+        options.add_argument('-headless')
+        return webdriver.Firefox(firefox_profile=profile, firefox_options=options)
+
+
+# Adds a script tag for arguments[0]; calls back with 'loaded' or 'blocked'
+LOAD_SCRIPT_JS = """
+var done = arguments[arguments.length - 1];
+var script = document.createElement('script');
+script.onload = function() { done('loaded'); };
+script.onerror = function() { done('blocked'); };
+script.src = arguments[0];
+document.head.appendChild(script);
+"""
+
+
+def execute_cdp_cmd(driver, cmd, params):
+    """
+    Run a DevTools protocol command in Chromium (`driver.execute_cdp_cmd` only
+    exists in newer Seleniums).
+    """
+    if hasattr(driver, 'execute_cdp_cmd'):
+        return driver.execute_cdp_cmd(cmd, params)
+    driver.command_executor._commands['executeCdpCommand'] = (
+        'POST', '/session/$sessionId/goog/cdp/execute')
+    return driver.execute('executeCdpCommand', {'cmd': cmd, 'params': params})['value']
+
+
+# READINESS WAITS
+################################################################################
+
+# Readiness checks run in the page; each returns a truthy value once satisfied.
+DOCUMENT_READY_JS = "return document.readyState === 'complete';"
+NO_PENDING_XHR_JS = "return !window.jQuery || window.jQuery.active === 0;"
+SLIDE_IMAGES_LOADED_JS = """
+var imgs = document.querySelectorAll('#slide-container img');
+// `complete` is also true for images that failed to load: don't wait on those
+return imgs.length > 0 && Array.prototype.every.call(imgs, function(img) {
+    return img.complete;
+});
+"""
+
+# The homepage has been loaded and its popup closed, so `getPage` can be called
+MARK_SESSION_WARM_JS = "window._chef_warm = true;"
+SESSION_WARM_JS = "return window._chef_warm === true && typeof getPage === 'function';"
+# `getPage` replaces the reader: mark the current one to know when that happened
+MARK_VIEWPORT_STALE_JS = """
+var viewport = document.getElementById('reader-viewport');
+if (viewport) { viewport.setAttribute('data-chef-stale', '1'); }
+"""
+FRESH_VIEWPORT_JS = """
+var viewport = document.getElementById('reader-viewport');
+return !!viewport && !viewport.hasAttribute('data-chef-stale');
+"""
+# Whether the reader shows story arguments[0]: the story object the site keeps,
+# an id attribute in the reader, or the story's folder in the slide images.
+STORY_MATCHES_JS = """
+var id = String(arguments[0]);
+var story = window.story || {};
+if ([story.id, story.storyId, story.story_id].map(String).indexOf(id) >= 0) { return true; }
+var viewport = document.getElementById('reader-viewport');
+var attrs = ['storyid', 'data-storyid', 'data-story-id', 'data-id'];
+var marked = Array.prototype.some.call(viewport.querySelectorAll('*'), function(el) {
+    return attrs.some(function(attr) { return el.getAttribute(attr) === id; });
+});
+return marked || Array.prototype.some.call(viewport.querySelectorAll('img[src]'), function(img) {
+    return img.getAttribute('src').indexOf('/' + id + '/') >= 0;
+});
+"""
+
+WAIT_TIMINGS = defaultdict(list)          # condition name -> list of waited seconds
+_wait_timings_lock = threading.Lock()
+
+
+def wait_until(driver, name, condition, required=True):
+    """
+    Poll `condition(driver)` until it returns a truthy value, for at most
+    `WAIT_TIMEOUTS[name]` seconds, and record in `WAIT_TIMINGS` how long it took.
+    Returns the condition's value, or `None` when a non-`required` wait times out.
+    """
+    start = time.time()
+    try:
+        return selenium_ui.WebDriverWait(
+                driver, WAIT_TIMEOUTS[name], poll_frequency=WAIT_POLL_INTERVAL
+            ).until(condition)
+    except TimeoutException:
+        print('Timed out after %ss waiting for %s' % (WAIT_TIMEOUTS[name], name))
+        if required:
+            raise
+        return None
+    finally:
+        with _wait_timings_lock:
+            WAIT_TIMINGS[name].append(time.time() - start)
+
+
+def script_condition(script):
+    return lambda driver: driver.execute_script(script)
+
+
+def visible_element(selector):
+    def condition(driver):
+        for element in driver.find_elements_by_css_selector(selector):
+            if element.is_displayed():
+                return element
+        return False
+    return condition
+
+
+class StableCount(object):
+    """
+    Wait condition that holds once the number of elements matching `selector`
+    has not changed for `settle_polls` consecutive polls.
+    """
+    def __init__(self, selector, settle_polls=STORY_COUNT_SETTLE_POLLS):
+        self.selector = selector
+        self.settle_polls = settle_polls
+        self.last_count = None
+        self.unchanged_polls = 0
+
+    def __call__(self, driver):
+        count = len(driver.find_elements_by_css_selector(self.selector))
+        if count == self.last_count:
+            self.unchanged_polls += 1
         else:
-            print('found duplicate of book.source_id', book.source_id, book.title)
+            self.last_count = count
+            self.unchanged_polls = 0
+        return self.unchanged_polls >= self.settle_polls and count
+
 
+def print_wait_timings():
+    print('Readiness waits (condition: count, mean, max seconds):')
+    for name, timings in sorted(WAIT_TIMINGS.items()):
+        print('  - %s: %s, %.2f, %.2f' % (
+            name, len(timings), sum(timings) / len(timings), max(timings)))
+        run_stats.wait(name, timings)
 
 
 def click_read_and_wait(driver):
@@ -221,99 +927,447 @@ def click_read_and_wait(driver):
     Clicks the READ link to load the page with the 3safeer apps, then async-loads
     all the elements of the page using the `loadMoreData` javascript function.
     """
+    wait_until(driver, 'document_ready', script_condition(DOCUMENT_READY_JS))
     read_link = driver.find_element_by_css_selector('#readLink')
     read_link.click()
-    selenium_ui.WebDriverWait(driver, 60).until(
+    wait_until(driver, 'stories_container',
             lambda driver: driver.find_element_by_id('stories-container'))
-    time.sleep(LOADING_WAIT_TIME)
-    previous_count = 0
+    wait_until(driver, 'no_pending_xhr', script_condition(NO_PENDING_XHR_JS))
+    previous_count = wait_until(driver, 'story_count_stable', StableCount('.story-cover'))
     while True:
-        story_count = len(driver.find_elements_by_css_selector('.story-cover'))
-        if story_count == previous_count or DOWNLOAD_ONE_TO_webroot:
+        if DOWNLOAD_ONE_TO_webroot:
             break
-        previous_count = story_count
         if DEBUG_MODE:
-            print('story_count =', story_count)
+            print('story_count =', previous_count)
             print('getting more data by calling window.loadMoreData()...')
         driver.execute_script('window.loadMoreData()')
-        time.sleep(LOADING_WAIT_TIME_SHORT)
+        wait_until(driver, 'no_pending_xhr', script_condition(NO_PENDING_XHR_JS))
+        story_count = wait_until(driver, 'story_count_stable', StableCount('.story-cover'))
+        if story_count == previous_count:
+            break
+        previous_count = story_count
+
+
+# Reads the info of every book on the READ page in a single round trip
+BOOK_INFOS_JS = """
+return Array.prototype.map.call(document.querySelectorAll('.story-cover'), function(book) {
+    function text(selector) {
+        var el = book.querySelector(selector);
+        return el ? (el.innerText || el.textContent || '') : '';
+    }
+    var cover = book.querySelector('picture.cover .noimage');
+    return {
+        book_id: book.getAttribute('storyid'),
+        cover_src: cover ? cover.src : '',
+        title: text('.cover-title'),
+        rating_text: text('.rating-icon')
+    };
+});
+"""
+
+# Reads the story count the site reports, if any
+CATALOG_TOTAL_JS = """
+var el = document.querySelector(arguments[0]);
+return el ? el.getAttribute('data-total') : null;
+"""
 
 
-def get_book_infos():
+def get_book_infos(refresh=False, browser=BROWSER, catalog_mode=CATALOG_FETCH_MODE):
     """
-    Simulate a web visitor that loads the entire list of books on the READ page.
-    Returns a list of dictionaries that contain the info for each book encountered.
+    Return a list of dictionaries that contain the info for each book in the
+    catalog. When `catalog_mode` is 'http' the catalog pages are fetched directly
+    from `CATALOG_PAGE_URL`; otherwise, or if that fails, we simulate a web visitor
+    that loads the entire list of books on the READ page.
+    The catalog is saved to `CATALOG_PATH`, and reused instead of going to the
+    website while it is less than `CATALOG_MAX_AGE_HOURS` old, unless `refresh`.
     """
     print('in get_book_infos')
-    with WebDriver("http://3asafeer.com/", delay=LOADING_WAIT_TIME_MS) as driver:
+    if not refresh:
+        book_infos = load_catalog(max_age_hours=CATALOG_MAX_AGE_HOURS)
+        if book_infos:
+            print('Using the %s books in the saved catalog %s' % (len(book_infos), CATALOG_PATH))
+            return book_infos
+
+    book_infos = None
+    if catalog_mode == 'http':
+        try:
+            with run_stats.stage('catalog_http'):
+                book_infos, total = fetch_book_infos()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print('Fetching the catalog over HTTP failed (%s)' % e)
+        else:
+            book_infos = check_catalog(book_infos, total)
+        if not book_infos:
+            print('Falling back to loading the catalog in the browser')
+            run_stats.count('catalog_browser_fallback')
+
+    if not book_infos:
+        with run_stats.stage('catalog_browser'):
+            book_infos, total = browse_book_infos(browser)
+        book_infos = check_catalog(book_infos, total)
+    if book_infos and not DOWNLOAD_ONE_TO_webroot:
+        save_catalog(book_infos)
+    return book_infos
+
+
+def browse_book_infos(browser=BROWSER):
+    """
+    Load the whole READ page in a browser and return its book infos along with
+    the total number of stories the site reports (or `None`).
+    """
+    with make_web_driver(browser, "http://3asafeer.com/", delay=0) as driver:
         click_read_and_wait(driver)
-        books = driver.find_elements_by_css_selector('.story-cover')
         book_infos = []
-        for book in books:
-            # print(book)
-            book_id = book.get_attribute('storyid')
-            cover_picture = book.find_element_by_css_selector('picture.cover')
-            cover_src = cover_picture.find_element_by_css_selector('.noimage').get_attribute('src')
-            thumbnail = make_fully_qualified_url(cover_src)
-            title = book.find_element_by_css_selector('.cover-title').text
-            rating_text = book.find_element_by_css_selector('.rating-icon').text.strip()
+        for book in driver.execute_script(BOOK_INFOS_JS):
             book_info = dict(
-                book_id=book_id,
-                title=title,
-                thumbnail=thumbnail,
-                rating_text=rating_text
+                book_id=book['book_id'],
+                title=book['title'].strip(),
+                thumbnail=make_fully_qualified_url(book['cover_src']),
+                rating_text=book['rating_text'].strip()
             )
             if DEBUG_MODE:
                 print('  - found book_info', book_info)
             book_infos.append(book_info)
-        return book_infos
+        total = parse_catalog_total(driver.execute_script(CATALOG_TOTAL_JS, CATALOG_TOTAL_SELECTOR))
+    return book_infos, total
+
+
+def fetch_book_infos(workers=CATALOG_WORKERS):
+    """
+    Page through `CATALOG_PAGE_URL` over HTTP and return the book infos of all
+    pages, in catalog order, along with the total reported by the site (or `None`).
+    When the site reports a total, all the remaining pages are fetched at once;
+    otherwise pages are fetched `workers` at a time until a batch has no books
+    we haven't seen, since the endpoint may repeat its last page when asked for
+    one past the end. Raises `ValueError` beyond `CATALOG_MAX_PAGES` pages.
+    """
+    book_infos, total = fetch_catalog_page(1)
+    pages = [book_infos]
+    per_page = len(book_infos)
+    if per_page == 0 or DOWNLOAD_ONE_TO_webroot:
+        return book_infos, total
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if total:
+            last_page = (total + per_page - 1) // per_page
+            if last_page > CATALOG_MAX_PAGES:
+                raise ValueError('a total of %s stories means %s catalog pages, more than %s'
+                                 % (total, last_page, CATALOG_MAX_PAGES))
+            for page_infos, _ in executor.map(fetch_catalog_page, range(2, last_page + 1)):
+                pages.append(page_infos)
+        else:
+            seen = set(book_info['book_id'] for book_info in book_infos)
+            page = 2
+            while True:
+                if page > CATALOG_MAX_PAGES:
+                    raise ValueError('the catalog did not end within %s pages' % CATALOG_MAX_PAGES)
+                batch = range(page, min(page + workers, CATALOG_MAX_PAGES + 1))
+                new_ids = set()
+                for page_infos, _ in executor.map(fetch_catalog_page, batch):
+                    pages.append(page_infos)
+                    new_ids.update(book_info['book_id'] for book_info in page_infos)
+                    if not page_infos:
+                        break
+                if not new_ids - seen or not pages[-1]:
+                    break
+                seen.update(new_ids)
+                page += workers
+    return [book_info for page_infos in pages for book_info in page_infos], total
+
+
+def fetch_catalog_page(page):
+    """
+    Fetch page number `page` of the catalog and return its book infos and the
+    total number of stories it reports (or `None`).
+    """
+    response = make_request(CATALOG_PAGE_URL.format(page=page), clear_cookies=False)
+    if response.status_code != 200:
+        raise ValueError('catalog page %s: HTTP %s' % (page, response.status_code))
+    doc = BeautifulSoup(response.text, HTML_PARSER)
+    total_el = doc.select_one(CATALOG_TOTAL_SELECTOR)
+    total = parse_catalog_total(total_el.get('data-total') if total_el else None)
+    if DEBUG_MODE:
+        print('  - catalog page', page, 'has', len(doc.select('.story-cover')), 'stories')
+    return book_infos_from_doc(doc), total
+
+
+def parse_catalog_total(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def check_catalog(book_infos, total):
+    """
+    Drop repeated books (pages can shift while the catalog is being read) and
+    warn if the catalog has fewer stories than the `total` the site reports.
+    """
+    seen = set()
+    unique_infos = []
+    for book_info in book_infos:
+        if book_info['book_id'] not in seen:
+            seen.add(book_info['book_id'])
+            unique_infos.append(book_info)
+    if len(unique_infos) < len(book_infos):
+        print('Dropped %s repeated books from the catalog' % (len(book_infos) - len(unique_infos)))
+    if total is None:
+        print('The site did not report a story count; catalog completeness not checked')
+    elif len(unique_infos) < total and not DOWNLOAD_ONE_TO_webroot:
+        print('WARNING: the catalog has %s stories but the site reports %s; %s are missing'
+              % (len(unique_infos), total, total - len(unique_infos)))
+        run_stats.count('catalog_missing', total - len(unique_infos))
+    return unique_infos
+
+
+def parse_book_infos(page_source):
+    """
+    Extract the same book infos as `BOOK_INFOS_JS` from a snapshot of the
+    READ page's source.
+    """
+    return book_infos_from_doc(BeautifulSoup(page_source, HTML_PARSER))
+
+
+def book_infos_from_doc(doc):
+    def text(book, selector):
+        el = book.select_one(selector)
+        return el.get_text().strip() if el else ''
+
+    book_infos = []
+    for book in doc.select('.story-cover'):
+        cover = book.select_one('picture.cover .noimage')
+        book_infos.append(dict(
+            book_id=book.get('storyid'),
+            title=text(book, '.cover-title'),
+            thumbnail=make_fully_qualified_url(cover.get('src', '') if cover else ''),
+            rating_text=text(book, '.rating-icon')
+        ))
+    return book_infos
+
+
+def load_catalog(max_age_hours=None):
+    """
+    Return the saved catalog, or `None` if there is none or it is too old.
+    """
+    try:
+        with open(CATALOG_PATH) as f:
+            catalog = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if max_age_hours and time.time() - catalog['saved_at'] > max_age_hours * 3600:
+        return None
+    return catalog['book_infos']
+
+
+def save_catalog(book_infos):
+    atomic_write(CATALOG_PATH, json.dumps(dict(saved_at=time.time(), book_infos=book_infos),
+                                          ensure_ascii=False, indent=2))
 
 
-def download_book(book_id, title, thumbnail, rating_text):
+def download_book(pool, book_id, title, thumbnail, rating_text, rebuild=False):
     """
-    Download book id=`book_id` by calling the website's `getPage(.,.,.)` function.
+    Download book id=`book_id` by calling the website's `getPage(.,.,.)` function
+    in a browser session from `pool`. The session goes back to the pool as soon
+    as the story is loaded, before the assets are downloaded.
     """
     print('in download_book, book_id =', book_id)
-    with WebDriver("http://3asafeer.com/", delay=LOADING_WAIT_TIME_MS) as driver:
-        if DEBUG_MODE:
-            print('Closing popup')
-        close_popup = driver.find_element_by_css_selector('.ui-dialog-titlebar-close')
-        close_popup.click()
-        time.sleep(LOADING_WAIT_TIME_SHORT)
+    with run_stats.stage('download_book'):
+        with pool.session() as driver:
+            page_source = load_story(driver, book_id)
+        doc = BeautifulSoup(page_source, HTML_PARSER)
+    return build_book(doc, book_id, title, thumbnail, rating_text, rebuild=rebuild)
 
-        print("Calling getPage('read', 'story', '%s')..." % book_id)
-        driver.execute_script("getPage('read', 'story', '{id}')".format(id=book_id))
-        time.sleep(LOADING_WAIT_TIME_SHORT*2)
 
-        try:
-            selenium_ui.WebDriverWait(driver, 30).until(
-                    lambda driver: driver.find_element_by_id('reader-viewport'))
-        except:
-            print("Not able to click into the book :(, check screenshot.png")
-            driver.save_screenshot('screenshot.png')
-            raise
+def load_story(driver, book_id):
+    """
+    Open the reader for story `book_id` in the browser session `driver` and
+    return the page source once the story has loaded. A session that already
+    has the site open goes straight to the story; the homepage is only loaded
+    again if that doesn't give us the requested story.
+    """
+    if story_navigation.enabled and driver.execute_script(SESSION_WARM_JS):
+        with run_stats.stage('in_session_navigation'):
+            page_source = navigate_to_story(driver, book_id)
+        if page_source is not None:
+            return page_source
+    open_homepage(driver)
+    try:
+        return open_story(driver, book_id)
+    except:
+        screenshot = 'screenshot-%s.png' % book_id
+        print("Not able to click into the book :(, check", screenshot)
+        driver.save_screenshot(screenshot)
+        raise
+
+
+def open_homepage(driver):
+    """
+    Load the homepage in `driver`, close its popup and mark the session as warm.
+    A new pooled session is already on the homepage, so it isn't loaded again.
+    """
+    fresh = (driver.current_url.split('#')[0].rstrip('/') == "http://3asafeer.com"
+             and not driver.execute_script(SESSION_WARM_JS))
+    if not fresh:
+        driver.get("http://3asafeer.com/")
+    wait_until(driver, 'document_ready', script_condition(DOCUMENT_READY_JS))
+
+    if DEBUG_MODE:
+        print('Closing popup')
+    close_popup = wait_until(driver, 'popup_visible',
+            visible_element('.ui-dialog-titlebar-close'))
+    close_popup.click()
+    wait_until(driver, 'popup_closed',
+            lambda driver: not visible_element('.ui-dialog')(driver))
+    wait_until(driver, 'no_pending_xhr', script_condition(NO_PENDING_XHR_JS))
+    driver.execute_script(MARK_SESSION_WARM_JS)
+
+
+def open_story(driver, book_id):
+    """
+    Call the site's `getPage` for story `book_id` and wait until the reader
+    shows it. Returns the page source.
+    """
+    print("Calling getPage('read', 'story', '%s')..." % book_id)
+    driver.execute_script("getPage('read', 'story', '{id}')".format(id=book_id))
+    wait_until(driver, 'reader_viewport', script_condition(FRESH_VIEWPORT_JS))
+    wait_until(driver, 'no_pending_xhr', script_condition(NO_PENDING_XHR_JS))
+    wait_until(driver, 'slide_images_loaded',
+            script_condition(SLIDE_IMAGES_LOADED_JS), required=False)
+    return driver.page_source
+
+
+def navigate_to_story(driver, book_id):
+    """
+    Go to story `book_id` from whatever the warm session `driver` is showing.
+    The current reader is marked stale first, so we can tell when `getPage`
+    has replaced it. Returns the page source, or `None` if the reader didn't
+    reset or doesn't show the requested story.
+    """
+    driver.execute_script(MARK_VIEWPORT_STALE_JS)
+    try:
+        page_source = open_story(driver, book_id)
+    except WebDriverException:
+        page_source = None
+    matched = page_source is not None and driver.execute_script(STORY_MATCHES_JS, book_id)
+    story_navigation.record(matched)
+    if not matched:
+        print('In-session navigation to story %s failed, reloading the homepage' % book_id)
+        run_stats.count('navigation_fallbacks')
+        return None
+    run_stats.count('in_session_navigations')
+    return page_source
+
+
+class StoryNavigation(object):
+    """
+    Whether `load_story` goes from story to story in a warm session. It stops
+    trying if the first `probe_books` attempts all fail, e.g. because the site
+    no longer marks which story the reader shows.
+    """
+    def __init__(self, enabled, probe_books):
+        self.enabled = enabled
+        self.probe_books = probe_books
+        self.matched = self.failed = 0
+        self._lock = threading.Lock()
+
+    def record(self, matched):
+        with self._lock:
+            if matched:
+                self.matched += 1
+            else:
+                self.failed += 1
+            if self.enabled and not self.matched and self.failed >= self.probe_books:
+                print('In-session navigation failed for the first %s stories, turning it off'
+                      % self.failed)
+                self.enabled = False
+
+
+story_navigation = StoryNavigation(IN_SESSION_NAVIGATION, IN_SESSION_PROBE_BOOKS)
+
+
+def fetch_book(book_id, title, thumbnail, rating_text, rebuild=False):
+    """
+    Browser-free version of `download_book`: builds the same document by putting
+    the fragment that `getPage('read', 'story', id)` would load into the
+    homepage. Returns `None` if the result doesn't look like a rendered story,
+    so the caller can fall back to the browser.
+    """
+    print('in fetch_book, book_id =', book_id)
+    try:
+        with run_stats.stage('fetch_book'):
+            doc = fetch_story_doc(book_id)
+    except Exception as e:
+        print('Direct fetch of story %s failed: %r' % (book_id, e))
+        return None
+    if not is_story_doc(doc):
+        print('Direct fetch of story %s did not validate, falling back to the browser' % book_id)
+        return None
+    return build_book(doc, book_id, title, thumbnail, rating_text, rebuild=rebuild)
+
+
+def fetch_story_doc(book_id, page='read', type='story'):
+    home = make_request("http://3asafeer.com/", clear_cookies=False)
+    fragment = make_request(GETPAGE_URL.format(page=page, type=type, id=book_id),
+                            clear_cookies=False)
+    if home.status_code != 200 or fragment.status_code != 200:
+        raise ValueError('HTTP %s / %s' % (home.status_code, fragment.status_code))
+    doc = BeautifulSoup(home.text, HTML_PARSER)
+    container = doc.select_one('#maincontent') or doc.body
+    container.clear()
+    container.append(BeautifulSoup(fragment.text, HTML_PARSER))
+    return doc
 
-        time.sleep(LOADING_WAIT_TIME)
 
-        doc = BeautifulSoup(driver.page_source, "html.parser")
-        return (process_node_from_doc(doc, book_id, title, thumbnail),
-                rating_text)
+def is_story_doc(doc):
+    """
+    Check that `doc` has the reader markup that `process_node_from_doc` expects.
+    """
+    return (doc.select_one('#reader-viewport') is not None
+            and doc.select_one('#slide-container .slide img[src]') is not None)
 
 
-def process_node_from_doc(doc, book_id, title, thumbnail):
+def build_book(doc, book_id, title, thumbnail, rating_text, rebuild=False):
+    """
+    Turn the story document `doc` into a `PendingBook`, or a `BookRecord` reusing
+    the previous zip if the story matches the one in the build manifest. Once
+    the entry is older than `MANIFEST_MAX_AGE_DAYS`, the story's assets must
+    match too, and the entry is then good for another `MANIFEST_MAX_AGE_DAYS`.
+    """
+    source_fingerprint = fingerprint_story(doc)
+    entry = assets_fingerprint = None
+    if not rebuild and not DOWNLOAD_ONE_TO_webroot:
+        entry = build_manifest.reusable_entry(
+            book_id, source=source_fingerprint, media=media_settings(),
+            runtime=runtime_bundle.digest)
+    if entry and time.time() - entry.get('checked_at', 0) > MANIFEST_MAX_AGE_DAYS * 86400:
+        assets_fingerprint = fingerprint_story_assets(doc)
+        if entry.get('story_assets') == assets_fingerprint:
+            build_manifest.record(book_id, checked_at=time.time())
+        else:
+            entry = None
+    if entry:
+        print('Story %s is unchanged, reusing %s' % (book_id, entry['zip_path']))
+        return BookRecord(book_id, title, entry['thumbnail'], entry['zip_path'], rating_text)
+    if assets_fingerprint is None:
+        assets_fingerprint = fingerprint_story_assets(doc)
+    return process_node_from_doc(doc, book_id, title, thumbnail, rating_text=rating_text,
+                                 source_fingerprint=source_fingerprint,
+                                 assets_fingerprint=assets_fingerprint)
+
+
+def process_node_from_doc(doc, book_id, title, thumbnail, rating_text=None,
+                          source_fingerprint=None, assets_fingerprint=None):
     """
-    Create a Ricecooker HTML5AppNode instance given the HTML source and metadata.
+    Collect the files of a book's HTML5 zip given the HTML source and metadata.
+    Returns a `PendingBook`, which writes the zip to `ZIPS_DIR` and records it in
+    the build manifest when finished.
     """
     if DOWNLOAD_ONE_TO_webroot:
         # Save the book's contents to the folder `webroot` in the chef root dir.
         # Use the script ./ricecooker/utils/kolibripreview.py to preview in K
-        destination = './webroot'
-        if os.path.exists(destination):
-            shutil.rmtree(destination)
-            os.mkdir(destination)
+        book = BookDirectory('./webroot')
     else:
-        # Create a temporary folder to download all the files for a book
-        destination = tempfile.mkdtemp()
+        # Write the book's files straight into its zip
+        book = BookZip(os.path.join(ZIPS_DIR, '%s.zip' % book_id))
 
     # Ensure the thumbnail is in a format Ricecooker can accept, and if not,
     # use the first slide as the thumbnail.
@@ -328,130 +1382,614 @@ def process_node_from_doc(doc, book_id, title, thumbnail):
             thumbnail = None
 
     # Download all the JS/CSS/images/audio/et needed to make a standalone app
-    doc = download_static_assets(doc, destination)
+    with run_stats.stage('download_static_assets'):
+        doc, assets = download_static_assets(doc, book)
 
-    # Remove a bunch of HTML that we don't want showing in our standalone app
+    # Remove a bunch of HTML that we don't want showing in our standalone app,
+    # and unnecessary scripts in the head and body
     doc.select_one('base')['href'] = ''
-    remove_node(doc, '#loading')
-    remove_node(doc, '#finishedActions')
-    remove_node(doc, '.bookmarkbtn')
-    remove_node(doc, '.reader-expand')
-    remove_node(doc, '#progressBar')
-    remove_node(doc, '#androidNotification')
-    remove_node(doc, '#exit')
-    remove_node(doc, '#ttmenu')
-
-    # Remove unnecessary scripts in the head
-    for pat in tag_content_patterns_to_remove_in_head:
-        remove_nodes_containing_pattern(doc, pat, parent_tag_name='head')
-    for pat in tag_content_patterns_to_remove_in_body:
-        remove_nodes_containing_pattern(doc, pat, parent_tag_name='body')
-    for pat_start, pat_end in cut_start_end_patterns:
-        remove_nodes_between_comments(doc, pat_start, pat_end, parent_tag_name='body')
+    removed_counts = cleanup_rules.apply(doc)
+    print('Cleanup removed', ', '.join('%s x %s' % (count, rule)
+                                       for rule, count in sorted(removed_counts.items())))
+    lazy_slides.apply(doc)
+    font_subsetter.apply(doc, book)
 
     # Write out the HTML source
-    with open(os.path.join(destination, "index.html"), "w") as f:
-        f.write(str(doc))
+    book.add_bytes("index.html", minifier.apply(doc, book).encode('utf-8'))
+    if memory_budget.low_memory:
+        # The tree is full of parent/sibling reference cycles; break them now
+        # rather than waiting for the garbage collector.
+        doc.decompose()
+
+    return PendingBook(book, BookRecord(book_id, title, thumbnail, book.path, rating_text),
+                       source=source_fingerprint,
+                       story_assets=assets_fingerprint,
+                       media=media_settings(),
+                       assets=asset_store.digests(assets),
+                       runtime=runtime_bundle.digest,
+                       thumbnail=thumbnail)
+
+
+# What the topic tree needs to know about a built book, small enough to keep
+# for the whole catalog and to save in a shard's book list.
+BookRecord = namedtuple('BookRecord', ['book_id', 'title', 'thumbnail', 'zip_path', 'rating'])
 
-    print("Downloaded book %s titled \"%s\" (thumbnail %s) to destination %s" % (
-        book_id, title, thumbnail, destination))
-    #preview_in_browser(destination)
 
-    zip_path = create_predictable_zip(destination)
+def make_book_node(record):
     return nodes.HTML5AppNode(
-        source_id=book_id,
-        title=truncate_metadata(title),
+        source_id=record.book_id,
+        title=truncate_metadata(record.title),
         license=licenses.CC_BY_NC_SALicense(copyright_holder='3asafeer.com'),
-        thumbnail=thumbnail,
-        files=[files.HTMLZipFile(zip_path)],
+        thumbnail=PrestagedThumbnailFile(record.thumbnail) if record.thumbnail else None,
+        files=[PrestagedHTMLZipFile(record.zip_path)],
         language="ar",
     )
 
 
-def remove_node(doc, selector):
+# PIPELINE
+################################################################################
+
+class Stage(object):
     """
-    Removes a DOM element from the tree.
+    A pool of `workers` threads fed through a queue of at most `queue_size`
+    jobs: `submit` blocks while the queue is full, so a stage can't run far
+    ahead of a slower one after it. Jobs are attributed to the submitter's book.
     """
-    node = doc.select_one(selector)
-    if node:
-        node.decompose()
-
-
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args, **kwargs):
+        start = time.time()
+        self._slots.acquire()
+        run_stats.count('%s_queue_wait_seconds' % self.name, time.time() - start)
+        try:
+            future = self._executor.submit(run_stats.in_current_book(fn), *args, **kwargs)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
 
-# DOM CLEANUP
-################################################################################
+    def close(self):
+        self._executor.shutdown(wait=True)
 
-tag_content_patterns_to_remove_in_head = [
-    'GoogleAnalyticsObject',
-    'chimpstatic.com',
-    'resolution=',
-    'facebook.com',
-    'fb_iframe_widget_fluid_desktop',
-    'connect.facebook.net',
-]
 
-tag_content_patterns_to_remove_in_body = [
-    'connect.facebook.net',
-    'refresh_session.php',
-]
+class PendingBook(object):
+    """
+    A book whose files are all known but whose zip isn't written yet.
+    `manifest_fields` are recorded in the build manifest once it is.
+    """
+    def __init__(self, book, record, **manifest_fields):
+        self.book = book
+        self.record = record
+        self.manifest_fields = manifest_fields
 
-def remove_nodes_containing_pattern(doc, pattern, parent_tag_name='body'):
+    def finish(self, **manifest_fields):
+        """
+        Write the zip and record it in the build manifest. Returns the `BookRecord`.
+        """
+        with run_stats.stage('write_zip'):
+            zip_path = self.book.close()
+        print("Downloaded book %s titled \"%s\" (thumbnail %s) to %s" % (
+            self.record.book_id, self.record.title, self.record.thumbnail, zip_path))
+        #preview_in_browser(zip_path)
+        if not DOWNLOAD_ONE_TO_webroot:
+            build_manifest.record(self.record.book_id,
+                                  zip_path=zip_path,
+                                  zip_hash=file_md5(zip_path),
+                                  checked_at=time.time(),
+                                  **dict(self.manifest_fields, **manifest_fields))
+        return self.record
+
+
+class BookPipeline(object):
     """
-    Remove DOM elements that text contain `pattern`.
+    The stages a book goes through after rendering: writing and hashing its
+    zip, then (unless `prestage` is False) copying its files into ricecooker's
+    storage so that ricecooker doesn't have to once the tree is returned.
     """
-    parent = doc.select_one(parent_tag_name)
-    for child in parent.find_all('script'):
-        if pattern in str(child):
-            child.extract()
-            if DEBUG_MODE:
-                print('removed from DOM:', str(child))
+    def __init__(self, prestage=True):
+        self.zip_stage = Stage('zip', ZIP_WORKERS, PIPELINE_QUEUE_SIZE)
+        self.prestage_stage = Stage('prestage', PRESTAGE_WORKERS, PIPELINE_QUEUE_SIZE)
+        self.prestage = prestage
+        self._prestaging = OrderedDict()        # zip path -> `Future`
+        self._lock = threading.Lock()
+
+    def finish(self, pending, **manifest_fields):
+        """
+        Queue `pending` (a `PendingBook`) to be written; returns a `Future` of
+        its `BookRecord`.
+        """
+        return self.zip_stage.submit(self._finish, pending, manifest_fields)
 
-cut_start_end_patterns = [
-    ('FB SDK Code Start', 'FB SDK Code End')
-]
+    def _finish(self, pending, manifest_fields):
+        try:
+            record = pending.finish(**manifest_fields)
+        except Exception as e:
+            print('Failed to write book %s: %r' % (pending.record.book_id, e))
+            run_stats.set_status('failed')
+            return None
+        self.queue_prestage(record)
+        return record
+
+    def queue_prestage(self, record):
+        if not self.prestage or record is None:
+            return
+        with self._lock:
+            if record.zip_path in self._prestaging:
+                return
+            self._prestaging[record.zip_path] = None
+        future = self.prestage_stage.submit(prestage_book, record)
+        with self._lock:
+            self._prestaging[record.zip_path] = future
+
+    def wait(self, results):
+        """
+        Resolve `results` (`BookRecord`s, `Future`s of them or `None`) in order,
+        make sure every book is prestaged, and wait for the prestaging to finish.
+        Returns the `BookRecord`s, with `None` for the books that failed.
+        """
+        records = [result.result() if isinstance(result, Future) else result
+                   for result in results]
+        for record in records:
+            self.queue_prestage(record)
+        for future in list(self._prestaging.values()):
+            future.result()
+        return records
+
+    def close(self):
+        self.zip_stage.close()
+        self.prestage_stage.close()
 
-def remove_nodes_between_comments(doc, pattern_start, pattern_end, parent_tag_name='body'):
+
+prestaged_files = {}            # book zip path or thumbnail URL -> ricecooker storage filename
+_storage_lock = threading.Lock()
+
+
+def prestage_book(record):
     """
-    Remove DOM elements between pattern_start and pattern_end inclusively.
+    Copy the zip and thumbnail of `record` into ricecooker's storage, named by
+    their MD5 like ricecooker's own `download` would. Files that can't be
+    prestaged are left to ricecooker.
     """
-    parent = doc.select_one(parent_tag_name)
-    el_start = parent.find(text=lambda el: isinstance(el,Comment) and pattern_start in str(el))
-    el_end = parent.find(text=lambda el: isinstance(el,Comment) and pattern_end in str(el))
-    if el_start and el_end:
-        el = el_start
-        while True:
-            if el == el_end:
-                el.extract()
-                break
-            next_el = el.nextSibling
-            if DEBUG_MODE:
-                print('removed from DOM:', str(el))
-            el.extract()
-            el = next_el
+    with run_stats.stage('prestage'):
+        try:
+            prestage_file(record.zip_path, 'zip')
+        except (IOError, ValueError) as e:
+            print('Could not prestage zip %s: %r' % (record.zip_path, e))
+            run_stats.count('prestage_failures')
+        if record.thumbnail:
+            try:
+                prestage_file(record.thumbnail, 'png')
+            except (IOError, ValueError) as e:
+                print('Could not prestage thumbnail %s: %r' % (record.thumbnail, e))
+                run_stats.count('prestage_failures')
+
+
+def prestage_file(path_or_url, default_ext):
+    if path_or_url in prestaged_files:
+        return
+    ext = os.path.splitext(urlparse(path_or_url).path)[1].lstrip('.').lower() or default_ext
+    if urlparse(path_or_url).scheme in ('http', 'https'):
+        response = make_request(path_or_url, clear_cookies=False)
+        if response.status_code != 200 or not response.content:
+            raise ValueError('HTTP %s' % response.status_code)
+        content = response.content
+        if Image is not None:
+            Image.open(io.BytesIO(content)).verify()
+        filename = '%s.%s' % (hashlib.md5(content).hexdigest(), ext)
+    else:
+        content = None
+        filename = '%s.%s' % (file_md5(path_or_url), ext)
+    with _storage_lock:
+        storage_path = config.get_storage_path(filename)
+    if not os.path.exists(storage_path):
+        if content is None:
+            with open(path_or_url, 'rb') as src, atomic_file(storage_path) as dest:
+                shutil.copyfileobj(src, dest, 1 << 20)
+        else:
+            atomic_write(storage_path, content)
+    prestaged_files[path_or_url] = filename
+    run_stats.count('prestaged_files')
 
 
-def truncate_metadata(data_string):
+class PrestagedFile(object):
     """
-    Avoid probelms with Studio and Kolibri DB constraints.
+    Mixin for ricecooker file classes: files that `prestage_file` has already
+    put in ricecooker's storage are not read and hashed again.
     """
-    MAX_CHARS = 190
-    if len(data_string) > MAX_CHARS:
-        data_string = data_string[:190] + " ..."
-        print('Truncating string', data_string, 'to length 190.')
-    return data_string
+    def process_file(self):
+        filename = prestaged_files.get(self.path)
+        if filename and os.path.exists(config.get_storage_path(filename)):
+            self.filename = filename
+            return filename
+        return super(PrestagedFile, self).process_file()
 
 
-CSS_URL_RE = re.compile(r"url\(['\"]?(.*?)['\"]?\)")
-IMAGES_IN_JS_RE = re.compile(r"images/(.*?)['\")]")
+class PrestagedHTMLZipFile(PrestagedFile, files.HTMLZipFile):
+    pass
 
 
-def download_static_assets(doc, destination):
+class PrestagedThumbnailFile(PrestagedFile, files.ThumbnailFile):
+    pass
+
+
+# BOOK OUTPUT
+################################################################################
+
+class BookZip(object):
     """
-    Download all the static assets for a given book's HTML soup.
+    The HTML5 zip of a book, written in one go by `close()`: files are streamed
+    into the zip from where they already are (mostly the asset store), in sorted
+    order and with neutral metadata, so the same content gives the same bytes.
+    """
+    DATE_TIME = (2015, 10, 21, 7, 28, 0)        # same as ricecooker's create_predictable_zip
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}                      # arcname -> path of a file, or bytes
+
+    def add_file(self, arcname, path):
+        self._entries.setdefault(arcname, path)
+
+    def add_bytes(self, arcname, content):
+        self._entries[arcname] = content
+
+    def replace_file(self, arcname, path):
+        self._entries[arcname] = path
+
+    def files(self):
+        """
+        The `(arcname, path)` of the entries added with `add_file`.
+        """
+        return [(arcname, path) for arcname, path in sorted(self._entries.items())
+                if not isinstance(path, bytes)]
+
+    def close(self):
+        with atomic_file(self.path) as f, zipfile.ZipFile(f, 'w') as zfile:
+            for arcname in sorted(self._entries):
+                info = zipfile.ZipInfo(arcname, date_time=self.DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.create_system = 0
+                content = self._entries[arcname]
+                if isinstance(content, bytes):
+                    zfile.writestr(info, content)
+                else:
+                    with open(content, 'rb') as src, zfile.open(info, 'w') as dest:
+                        shutil.copyfileobj(src, dest, 1 << 20)
+        return self.path
+
+
+class BookDirectory(object):
+    """
+    Same interface as `BookZip`, but writes the book's files into a directory.
+    Used for the `webroot/` debug output.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _target(self, arcname):
+        target = os.path.join(self.path, arcname)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return target
+
+    def add_file(self, arcname, path):
+        shutil.copyfile(path, self._target(arcname))
+
+    def add_bytes(self, arcname, content):
+        with open(self._target(arcname), 'wb') as f:
+            f.write(content)
+
+    def replace_file(self, arcname, path):
+        self.add_file(arcname, path)
+
+    def files(self):
+        for root, _, filenames in os.walk(self.path):
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, self.path), path
+
+    def close(self):
+        return self.path
+
+
+def add_static_files(book, static_dir="static"):
+    """
+    Add our own JS/CSS files from `static_dir` to `book` under `static/`.
+    """
+    for root, _, filenames in os.walk(static_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            book.add_file(os.path.join("static", os.path.relpath(path, static_dir)), path)
+
+
+# BUILD MANIFEST
+################################################################################
+
+class BuildManifest(object):
+    """
+    Persistent record, keyed by `book_id`, of the books built by previous runs:
+    fingerprints of the catalog entry and of the rendered story, the hashes of
+    the book's assets, and the path and MD5 of the resulting zip.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.books = json.load(f)
+        except (IOError, ValueError):
+            self.books = {}
+
+    def reusable_entry(self, book_id, max_age_days=None, **expected):
+        """
+        Return the entry for `book_id` if it matches all the `expected` field
+        values, was checked in the last `max_age_days` and its zip is intact.
+        """
+        entry = self.books.get(book_id)
+        if not entry or 'zip_path' not in entry:
+            return None
+        if any(entry.get(key) != value for key, value in expected.items()):
+            return None
+        if max_age_days and time.time() - entry.get('checked_at', 0) > max_age_days * 86400:
+            return None
+        if not os.path.exists(entry['zip_path']) or file_md5(entry['zip_path']) != entry['zip_hash']:
+            return None
+        return entry
+
+    def record(self, book_id, **fields):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Shards running on the same machine share the manifest: take the file
+        # lock and merge in what the others recorded before writing it back.
+        with self._lock, open(self.path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    self.books.update(json.load(f))
+            except (IOError, ValueError):
+                pass
+            self.books.setdefault(book_id, {}).update(fields)
+            atomic_write(self.path, json.dumps(self.books, indent=2, sort_keys=True))
+
+
+build_manifest = BuildManifest(BUILD_MANIFEST_PATH)
+
+
+def fingerprint(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def fingerprint_story(doc):
+    """
+    Fingerprint the story-specific part of a rendered page, ignoring the site
+    chrome around the reader.
+    """
+    reader = doc.select_one('#reader-viewport') or doc
+    return fingerprint(str(reader))
+
+
+def fingerprint_story_assets(doc):
+    """
+    Fingerprint the content of the assets of the story in `doc`, other than the
+    shared runtime, including those its inline styles and scripts link to. They
+    come from the asset store, so within a run each one is fetched once (and the
+    build reuses it), and across runs the HTTP cache only revalidates them.
+    """
+    assets = asset_store.get_many([(url, None, content_middleware)
+                                   for _, _, url, content_middleware in find_static_assets(doc)
+                                   if url not in runtime_bundle.assets])
+    for node in doc.select('style'):
+        runtime_bundle.run_inline(css_content_middleware, node.get_text(), deps=assets)
+    for node in doc.select('script'):
+        if not node.attrs.get('src'):
+            runtime_bundle.run_inline(js_middleware, node.get_text(), deps=assets)
+    return fingerprint(json.dumps(asset_store.digests(assets), sort_keys=True))
+
+
+@contextmanager
+def atomic_file(path, mode='wb'):
+    """
+    Open a temporary file next to `path` for writing, and move it to `path`
+    once the block is done, so that other threads and processes never see a
+    partly written file. The temporary file is removed if the block raises.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode, **({} if 'b' in mode else dict(encoding='utf-8'))) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write(path, data):
+    """
+    Write `data` (bytes or text) to `path` through `atomic_file`.
+    """
+    with atomic_file(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# DOM CLEANUP
+################################################################################
+
+selectors_to_remove = [
+    '#loading',
+    '#finishedActions',
+    '.bookmarkbtn',
+    '.reader-expand',
+    '#progressBar',
+    '#androidNotification',
+    '#exit',
+    '#ttmenu',
+]
+
+tag_content_patterns_to_remove_in_head = [
+    'GoogleAnalyticsObject',
+    'chimpstatic.com',
+    'resolution=',
+    'facebook.com',
+    'fb_iframe_widget_fluid_desktop',
+    'connect.facebook.net',
+]
+
+tag_content_patterns_to_remove_in_body = [
+    'connect.facebook.net',
+    'refresh_session.php',
+]
+
+cut_start_end_patterns = [
+    ('FB SDK Code Start', 'FB SDK Code End')
+]
+
+SIMPLE_SELECTOR_RE = re.compile(r'^([#.])([\w-]+)$')
+
+
+class CleanupRules(object):
+    """
+    The DOM cleanup rules, compiled once and applied in a single traversal of
+    the document:
+      - `selectors`: elements to remove; `#id` and `.class` selectors are looked
+        up in sets, anything else is matched with a compiled soupsieve selector
+      - `head_patterns`, `body_patterns`: remove `<script>` tags in the head or
+        body whose attributes or code contain any of the patterns
+      - `comment_ranges`: `(start, end)` patterns of comments in the body; the
+        start comment, its following siblings and the end comment are removed
+    `apply()` returns how many nodes each rule removed.
+    """
+    def __init__(self, selectors=(), head_patterns=(), body_patterns=(), comment_ranges=()):
+        self.ids, self.classes, self.other_selectors = {}, {}, []
+        for selector in selectors:
+            match = SIMPLE_SELECTOR_RE.match(selector)
+            if not match:
+                self.other_selectors.append((selector, soupsieve.compile(selector)))
+            elif match.group(1) == '#':
+                self.ids[match.group(2)] = selector
+            else:
+                self.classes[match.group(2)] = selector
+        self.script_patterns = {'head': list(head_patterns), 'body': list(body_patterns)}
+        self.script_res = {
+            scope: re.compile('|'.join('(%s)' % re.escape(pat) for pat in patterns))
+            for scope, patterns in self.script_patterns.items() if patterns
+        }
+        self.comment_ranges = list(comment_ranges)
+
+    def apply(self, doc):
+        counts = defaultdict(int)
+        for scope in ('head', 'body'):
+            root = doc.find(scope)
+            if root:
+                self._apply(root, scope, counts)
+        return counts
+
+    def _apply(self, root, scope, counts):
+        doomed = []
+        range_starts = []
+        stack = list(reversed(root.contents))
+        while stack:
+            el = stack.pop()
+            if isinstance(el, Comment):
+                if scope == 'body':
+                    range_starts.extend((el, start, end) for start, end in self.comment_ranges
+                                        if start in el)
+                continue
+            if not isinstance(el, Tag):
+                continue
+            rule = self._match(el, scope)
+            if rule:
+                # Everything under a removed node goes with it
+                doomed.append((el, rule))
+                continue
+            stack.extend(reversed(el.contents))
+
+        for el, rule in doomed:
+            if DEBUG_MODE:
+                print('removed from DOM:', str(el))
+            el.decompose()
+            counts[rule] += 1
+
+        for el_start, start, end in range_starts:
+            siblings = [el_start]
+            for el in el_start.next_siblings:
+                siblings.append(el)
+                if isinstance(el, Comment) and end in el:
+                    break
+            else:
+                continue            # no end comment at the same level; leave it alone
+            for el in siblings:
+                if DEBUG_MODE:
+                    print('removed from DOM:', str(el))
+                el.extract()
+            counts['%s ... %s' % (start, end)] += len(siblings)
+
+    def _match(self, el, scope):
+        """
+        Return the name of the first rule that removes the element `el`.
+        """
+        if el.get('id') in self.ids:
+            return self.ids[el['id']]
+        for cls in el.get('class', []):
+            if cls in self.classes:
+                return self.classes[cls]
+        for selector, compiled in self.other_selectors:
+            if compiled.match(el):
+                return selector
+        script_re = self.script_res.get(scope)
+        if el.name == 'script' and script_re:
+            attrs = ' '.join(str(value) for value in el.attrs.values())
+            match = script_re.search(attrs) or script_re.search(el.string or '')
+            if match:
+                return 'script:%s' % self.script_patterns[scope][match.lastindex - 1]
+        return None
+
+
+cleanup_rules = CleanupRules(selectors=selectors_to_remove,
+                             head_patterns=tag_content_patterns_to_remove_in_head,
+                             body_patterns=tag_content_patterns_to_remove_in_body,
+                             comment_ranges=cut_start_end_patterns)
+
 
-    Will download JS, CSS, images, and audio clips.
+def truncate_metadata(data_string):
     """
-    # Helper function to download all assets for a given CSS selector.
+    Avoid probelms with Studio and Kolibri DB constraints.
+    """
+    MAX_CHARS = 190
+    if len(data_string) > MAX_CHARS:
+        data_string = data_string[:190] + " ..."
+        print('Truncating string', data_string, 'to length 190.')
+    return data_string
+
+
+CSS_URL_RE = re.compile(r"url\(['\"]?(.*?)['\"]?\)")
+IMAGES_IN_JS_RE = re.compile(r"images/(.*?)['\")]")
+
+
+def find_static_assets(doc):
+    """
+    Return the JS, CSS, images, and audio clips linked from `doc` as a list of
+    `(node, attr, url, content_middleware)` in document order. Nodes we don't
+    want (blacklisted, preconnect links, ...) are removed from `doc`.
+    """
+    jobs = []
+
+    # Helper function to queue the assets for a given CSS selector.
     def download_assets(selector, attr, url_middleware=None,
             content_middleware=None, node_filter=None):
         nodes = doc.select(selector)
@@ -483,63 +2021,7 @@ def download_static_assets(doc, destination):
             if url_middleware:
                 url = url_middleware(url)
 
-            filename = derive_filename(url)
-            node[attr] = filename
-
-            print("Downloading", url, "to filename", filename)
-            download_file(url, destination, request_fn=make_request,
-                    filename=filename, middleware_callbacks=content_middleware)
-
-    def js_middleware(content, url, **kwargs):
-        if DEBUG_MODE:
-            print('in js_middleware', url)
-        # Download all images referenced in JS files
-        for img in IMAGES_IN_JS_RE.findall(content):
-            url = make_fully_qualified_url('/images/%s' % img)
-            print("Downloading", url, "to filename", img)
-            download_file(url, destination, subpath="images",
-                    request_fn=make_request, filename=img)
-
-        # Monkey-patch the js code that use localStorage and document.cookie so
-        # to use window._localStorage (a plain js object) instead real localStorage
-        # This change primarily affects the functions getStoredValue and setStoredValue
-        # which are used to set the following properties:
-        #  - diffRange: sets age-range for stories (needed to avoid a dialog popup)
-        #  - lng: set to arabic
-        #  - audio: toggles between read-aloud vs. no read-aloud
-        return (content
-            .replace("localStorage", "_localStorage")
-            .replace('document.cookie.split', '"".split')
-            .replace('document.cookie', 'window._document_cookie'))
-
-    def css_url_middleware(url):
-        if DEBUG_MODE:
-            print('in css_url_middleware', url)
-        # Somehow the minified app CSS doesn't render images. Download the
-        # original.
-        return url.replace("app.min.css", "app.css")
-
-    def css_node_filter(node):
-        return "stylesheet" in node["rel"]
-
-    def css_content_middleware(content, url, **kwargs):
-        if DEBUG_MODE:
-            print('in css_content_middleware', url)
-        # Download linked fonts and images
-        def repl(match):
-            src = match.group(1)
-            if src.startswith('//localhost'):
-                return 'src()'
-            # Don't download data: files
-            if src.startswith('data:'):
-                return match.group(0)
-            src_url = make_fully_qualified_url(src)
-            derived_filename = derive_filename(src_url)
-            download_file(src_url, destination, request_fn=make_request,
-                    filename=derived_filename)
-            return 'src("%s")' % derived_filename
-
-        return CSS_URL_RE.sub(repl, content)
+            jobs.append((node, attr, url, content_middleware))
 
     # Download all linked static assets
     # 1. Images
@@ -553,19 +2035,51 @@ def download_static_assets(doc, destination):
     # 4. Audio
     download_assets("source[src]", "src")
     download_assets("source[srcset]", "srcset")
+    return jobs
+
+
+def download_static_assets(doc, book):
+    """
+    Download all the static assets for a given book's HTML soup.
+
+    Will download JS, CSS, images, and audio clips. Returns the rewritten soup
+    and the list of story-specific `Asset`s added to `book` (a `BookZip` or
+    `BookDirectory`); the shared ones come from the `runtime_bundle`.
+    """
+    book_assets = []
+    jobs = []           # (node, attr, url, content_middleware) in document order
+    for node, attr, url, content_middleware in find_static_assets(doc):
+        if url in runtime_bundle.assets:
+            node[attr] = runtime_bundle.assets[url].relpath
+        else:
+            jobs.append((node, attr, url, content_middleware))
+
+    # Fetch everything concurrently, then rewrite the nodes in document order
+    assets = asset_store.get_many([(url, None, content_middleware)
+                                   for _, _, url, content_middleware in jobs])
+    for (node, attr, _, _), asset in zip(jobs, assets):
+        node[attr] = asset.relpath
+        if node.name == 'source' and attr == 'src' and audio_transcoder.enabled:
+            book_assets.extend(audio_transcoder.rewrite(doc, node, asset))
+        else:
+            book_assets.append(asset)
 
     # ... and also run the middleware on CSS/JS embedded in the page source to
     # get resources linked to in .css and .js files
     for node in doc.select('style'):
-        node.string = css_content_middleware(node.get_text(), url='')
+        node.string = runtime_bundle.run_inline(css_content_middleware, node.get_text(),
+                                                deps=book_assets)
 
     for node in doc.select('script'):
         if not node.attrs.get('src'):
-            node.string = js_middleware(node.get_text(), url='')
+            node.string = runtime_bundle.run_inline(js_middleware, node.get_text(),
+                                                    deps=book_assets)
+
+    asset_store.add_to(book_assets, book)
 
-    # Copy over some of our own JS/CSS files and then add links to them in the
-    # page source.
-    copy_tree("static", os.path.join(destination, "static"))
+    # Copy over the shared runtime, including our own JS/CSS files, and then
+    # add links to ours in the page source.
+    runtime_bundle.add_to(book)
 
 
     # HEAD START
@@ -599,7 +2113,1253 @@ def download_static_assets(doc, destination):
     # BODY END
 
 
-    return doc
+    return doc, book_assets
+
+
+def js_middleware(content, url, deps, **kwargs):
+    if DEBUG_MODE:
+        print('in js_middleware', url)
+    # Download all images referenced in JS files; the regex also catches
+    # strings that merely look like image paths, so missing ones are skipped.
+    imgs = list(OrderedDict.fromkeys(IMAGES_IN_JS_RE.findall(content)))
+    deps.extend(asset_store.get_many([
+        (make_fully_qualified_url('/images/%s' % img), 'images/%s' % img, None)
+        for img in imgs], optional=True))
+
+    # Monkey-patch the js code that use localStorage and document.cookie so
+    # to use window._localStorage (a plain js object) instead real localStorage
+    # This change primarily affects the functions getStoredValue and setStoredValue
+    # which are used to set the following properties:
+    #  - diffRange: sets age-range for stories (needed to avoid a dialog popup)
+    #  - lng: set to arabic
+    #  - audio: toggles between read-aloud vs. no read-aloud
+    return (content
+        .replace("localStorage", "_localStorage")
+        .replace('document.cookie.split', '"".split')
+        .replace('document.cookie', 'window._document_cookie'))
+
+
+def css_url_middleware(url):
+    if DEBUG_MODE:
+        print('in css_url_middleware', url)
+    # Somehow the minified app CSS doesn't render images. Download the
+    # original.
+    return url.replace("app.min.css", "app.css")
+
+
+def css_node_filter(node):
+    return "stylesheet" in node["rel"]
+
+
+def css_content_middleware(content, url, deps, **kwargs):
+    if DEBUG_MODE:
+        print('in css_content_middleware', url)
+    # Download linked fonts and images
+    def is_downloadable(src):
+        # Don't download data: files
+        return not src.startswith('//localhost') and not src.startswith('data:')
+
+    srcs = list(OrderedDict.fromkeys(
+        src for src in CSS_URL_RE.findall(content) if is_downloadable(src)))
+    assets = dict(zip(srcs, asset_store.get_many(
+        [(make_fully_qualified_url(src), None, None) for src in srcs])))
+
+    def repl(match):
+        src = match.group(1)
+        if src.startswith('//localhost'):
+            return 'src()'
+        if not is_downloadable(src):
+            return match.group(0)
+        asset = assets[src]
+        deps.append(asset)
+        return 'src("%s")' % asset.relpath
+
+    return CSS_URL_RE.sub(repl, content)
+
+
+# ASSET STORE
+################################################################################
+
+Asset = namedtuple('Asset', ['relpath', 'path', 'deps'])
+
+
+class AssetStore(object):
+    """
+    Run-wide store for the static assets of all books. Each URL is downloaded
+    and passed through its content middleware only once; the result is kept in
+    `root` under its content hash and added to every book that uses it, under a
+    filename derived from that hash.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}                   # (url, relpath, middleware) -> Asset
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(ASSET_HOST_CONCURRENCY))
+
+    def get(self, url, relpath=None, content_middleware=None):
+        """
+        Return the `Asset` for `url`, downloading it if this is the first request.
+        `relpath` fixes the path of the asset inside the book directory; by
+        default it is derived from the content hash and the URL's basename.
+        """
+        key = (url, relpath, content_middleware.__name__ if content_middleware else None)
+        with self._lock:
+            key_lock = self._locks[key]
+        with key_lock:
+            if key not in self._assets:
+                self._assets[key] = self._fetch(url, relpath, content_middleware)
+            return self._assets[key]
+
+    def get_many(self, items, optional=False):
+        """
+        Return the `Asset`s for a list of `(url, relpath, content_middleware)`
+        items, in the same order, downloading them concurrently. A download
+        that fails raises `ValueError`, unless `optional`: then only the
+        assets that could be downloaded are returned.
+        """
+        fetch = self._get_optional if optional else self.get
+        if len(items) < 2:
+            return [asset for asset in map(lambda item: fetch(*item), items)
+                    if asset is not None or not optional]
+        # A fresh executor per call: middlewares call `get_many` from inside
+        # worker threads, and must not wait on a pool they are occupying.
+        fetch_in_book = run_stats.in_current_book(fetch)
+        with ThreadPoolExecutor(max_workers=min(ASSET_WORKERS, len(items))) as executor:
+            assets = list(executor.map(lambda item: fetch_in_book(*item), items))
+        return [asset for asset in assets if asset is not None or not optional]
+
+    def _get_optional(self, url, relpath=None, content_middleware=None):
+        try:
+            return self.get(url, relpath, content_middleware)
+        except ValueError as e:
+            print('Skipping optional asset:', e)
+            return None
+
+    def _fetch(self, url, relpath, content_middleware):
+        print("Downloading", url)
+        # Only the network request counts against the host's limit, not the
+        # middleware, which may wait on downloads from the same host.
+        start = time.time()
+        with self._host_slots[urlparse(url).netloc]:
+            response = make_request(url)
+        if response.status_code != 200:
+            # Fail the book's attempt rather than putting an error page in its zip
+            raise ValueError('%s: HTTP %s' % (url, response.status_code))
+        content = response.content
+        run_stats.asset(url, time.time() - start, len(content))
+        deps = []
+        if content_middleware:
+            with run_stats.stage(content_middleware.__name__):
+                content = content_middleware(content.decode(), url=url, deps=deps).encode()
+        path = self.store(content)
+        return Asset(relpath or derive_filename(url, os.path.basename(path)), path, tuple(deps))
+
+    def store(self, content):
+        """
+        Save `content` under its hash, if it isn't there yet, and return its path.
+        """
+        digest = hashlib.sha1(content).hexdigest()
+        path = os.path.join(self.root, digest)
+        if not os.path.exists(path):
+            atomic_write(path, content)
+        return path
+
+    @staticmethod
+    def digests(assets):
+        """
+        Map the relative path of `assets`, and of their dependencies, to the
+        content hash they are stored under.
+        """
+        digests = {}
+        pending = list(assets)
+        while pending:
+            asset = pending.pop()
+            pending.extend(asset.deps)
+            digests[asset.relpath] = os.path.basename(asset.path)
+        return digests
+
+    def add_to(self, assets, book):
+        """
+        Add `assets`, and all the assets they depend on, to `book`.
+        """
+        for relpath, digest in self.digests(assets).items():
+            book.add_file(relpath, image_optimizer.optimize(relpath, os.path.join(self.root, digest)))
+
+
+asset_store = AssetStore(ASSET_STORE_DIR)
+
+
+# RUNTIME BUNDLE
+################################################################################
+
+class RuntimeBundle(object):
+    """
+    The reader runtime that every book shares: the site's scripts and
+    stylesheets (after their middlewares) with everything they link to, and
+    our `static/` overlays. It is fetched, rewritten and verified once per run
+    by `build()`, then `add_to()` links the same files into each book.
+    """
+    def __init__(self, static_dir='static'):
+        self.static_dir = static_dir
+        self.assets = {}            # url -> `Asset`, for the shared scripts and stylesheets
+        self.files = None           # sorted (relpath, path) of all the runtime files
+        self.digest = None          # fingerprint of `files`, recorded in the build manifest
+        self._inline = {}           # (middleware, fingerprint of text) -> (result, deps)
+
+    def build(self, page_url="http://3asafeer.com/"):
+        """
+        Collect the scripts and stylesheets in the head of `page_url`, which
+        all the story pages share.
+        """
+        with run_stats.stage('runtime_bundle'):
+            response = make_request(page_url, clear_cookies=False)
+            if response.status_code != 200:
+                print('Could not load %s to build the runtime bundle, books will '
+                      'fetch it themselves' % page_url)
+                return
+            doc = BeautifulSoup(response.text, HTML_PARSER)
+            jobs = [job for job in find_static_assets(doc)
+                    if job[0].find_parent('head') and job[0].name in ('link', 'script')]
+            try:
+                assets = asset_store.get_many([(url, None, content_middleware)
+                                               for _, _, url, content_middleware in jobs])
+            except (ValueError, requests.exceptions.RequestException) as e:
+                print('Could not download the runtime bundle (%s), books will fetch '
+                      'it themselves' % e)
+                return
+            files = {os.path.join('static', os.path.relpath(path, self.static_dir)): path
+                     for path in self._static_paths()}
+            for relpath, digest in asset_store.digests(assets).items():
+                path = os.path.join(asset_store.root, digest)
+                self.verify(relpath, path, digest)
+                files[relpath] = image_optimizer.optimize(relpath, path)
+            self.assets = {url: asset for (_, _, url, _), asset in zip(jobs, assets)}
+            self.files = sorted(files.items())
+            self.digest = fingerprint(json.dumps(
+                [(relpath, file_md5(path)) for relpath, path in self.files]))
+        print('Runtime bundle: %s shared scripts and stylesheets, %s files in all' % (
+            len(self.assets), len(self.files)))
+
+    def _static_paths(self):
+        for root, _, filenames in os.walk(self.static_dir):
+            for filename in sorted(filenames):
+                yield os.path.join(root, filename)
+
+    @staticmethod
+    def verify(relpath, path, digest):
+        """
+        Check that the asset store file for `relpath` still has the content it
+        was stored under; a corrupt file is removed so the next run refetches it.
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        if sha1.hexdigest() != digest:
+            os.remove(path)
+            raise ValueError('Runtime file %s (%s) is corrupt; removed it, please rerun'
+                             % (relpath, path))
+
+    def add_to(self, book):
+        if self.files is None:
+            add_static_files(book, self.static_dir)
+            return
+        for relpath, path in self.files:
+            book.add_file(relpath, path)
+
+    def run_inline(self, middleware, content, deps):
+        """
+        Run `middleware` on a `<style>` or `<script>` embedded in a page. Most
+        of them are the same in every book, so results are kept for the run.
+        """
+        key = (middleware.__name__, fingerprint(content))
+        if key not in self._inline:
+            inline_deps = []
+            self._inline[key] = (middleware(content, url='', deps=inline_deps), inline_deps)
+        result, inline_deps = self._inline[key]
+        deps.extend(inline_deps)
+        return result
+
+
+runtime_bundle = RuntimeBundle()
+
+
+# MEDIA OPTIMIZATION
+################################################################################
+
+class MediaStage(object):
+    """
+    An optional stage that rewrites the files of each book and keeps its
+    results in `root`, so each file is processed once across books and runs.
+    Subclasses set `name`, the run stats stage, and `errors`, the failures that
+    leave a file as it is.
+    """
+    name = None
+    errors = (OSError, ValueError)
+
+    def __init__(self, root):
+        self.root = root
+        self.enabled = False
+        self._hashes = {}               # path of a source file -> its MD5
+
+    def source_hash(self, path):
+        if path not in self._hashes:
+            self._hashes[path] = file_md5(path)
+        return self._hashes[path]
+
+    def cached(self, out_path, make_content, label):
+        """
+        Return `out_path`, writing `make_content()` to it first unless an earlier
+        book or run already did, or None if `make_content` fails.
+        """
+        if os.path.exists(out_path):
+            run_stats.count('%s_cache_hits' % self.name)
+            return out_path
+        with run_stats.stage(self.name):
+            try:
+                content = make_content()
+            except self.errors as e:
+                print('%s failed for %s: %r' % (self.name, label, e))
+                return None
+        atomic_write(out_path, content)
+        return out_path
+
+
+class ImageOptimizer(MediaStage):
+    """
+    Resizes images to fit in `max_dimension` and recompresses them, keeping
+    their format and file name so the book's HTML, CSS and JS still refer to
+    them. Results are cached in `root` by source hash and settings, so each
+    image is processed once.
+    """
+    name = 'optimize_images'
+    extensions = ('.jpg', '.jpeg', '.png')
+
+    def __init__(self, root):
+        super(ImageOptimizer, self).__init__(root)
+        self.max_dimension = self.jpeg_quality = None
+
+    def enable(self, max_dimension, jpeg_quality):
+        if Image is None:
+            print('Pillow is not installed, images will not be optimized')
+            return
+        self.enabled = True
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+
+    def settings(self):
+        """
+        A string describing the optimization settings, or None if disabled.
+        """
+        if not self.enabled:
+            return None
+        return '%spx-q%s' % (self.max_dimension, self.jpeg_quality)
+
+    def optimize(self, relpath, path):
+        """
+        Return the path of the optimized version of the image at `path`, or
+        `path` itself if it isn't an image or optimization is disabled.
+        """
+        ext = os.path.splitext(relpath)[1].lower()
+        if not self.enabled or ext not in self.extensions:
+            return path
+        out_path = self.cached(
+            os.path.join(self.root, '%s-%s%s' % (os.path.basename(path), self.settings(), ext)),
+            lambda: self._optimized_content(path, ext), relpath)
+        if out_path is None:
+            return path
+        run_stats.count('image_bytes_saved', os.path.getsize(path) - os.path.getsize(out_path))
+        return out_path
+
+    def _optimized_content(self, path, ext):
+        with open(path, 'rb') as f:
+            original = f.read()
+        image = Image.open(path)
+        image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+        output = io.BytesIO()
+        if ext == '.png':
+            image.save(output, 'PNG', optimize=True)
+        else:
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=self.jpeg_quality, optimize=True,
+                       progressive=True)
+        # Keep the original if recompressing didn't make it any smaller
+        return min(original, output.getvalue(), key=len)
+
+
+image_optimizer = ImageOptimizer(MEDIA_DIR)
+
+
+class AudioTranscoder(MediaStage):
+    """
+    Transcodes the read-aloud audio with ffmpeg to a mono `codec` at
+    `bitrate`. The transcoded file goes in the asset store; `root` keeps which
+    one belongs to each source hash and settings, so each clip is encoded once.
+    """
+    codecs = {                  # name -> (ffmpeg encoder and options, extension, MIME type)
+        'opus': (['-c:a', 'libopus', '-application', 'voip'], '.ogg', 'audio/ogg; codecs=opus'),
+        'mp3': (['-c:a', 'libmp3lame'], '.mp3', 'audio/mpeg'),
+        'aac': (['-c:a', 'aac'], '.m4a', 'audio/mp4'),
+    }
+    name = 'transcode_audio'
+    extensions = ('.mp3', '.m4a', '.ogg', '.oga', '.wav')
+    # Codecs that some of the browsers Kolibri runs in (older Safari and iOS) can't play
+    needs_fallback = ('opus',)
+
+    def __init__(self, root):
+        super(AudioTranscoder, self).__init__(root)
+        self.codec = self.bitrate = None
+        self.fallback = True
+
+    def enable(self, codec, bitrate, fallback):
+        if shutil.which('ffmpeg') is None:
+            print('ffmpeg is not installed, audio will not be transcoded')
+            return
+        self.enabled = True
+        self.codec = codec
+        self.bitrate = bitrate
+        self.fallback = fallback
+
+    def settings(self):
+        """
+        A string describing the transcoding settings, or None if disabled.
+        """
+        if not self.enabled:
+            return None
+        return self.encoding() + ('-fallback' if self.keeps_original() else '')
+
+    def encoding(self):
+        return '%s-%s' % (self.codec, self.bitrate)
+
+    def keeps_original(self):
+        """
+        Whether the original audio is kept as a fallback for the transcoded one.
+        """
+        return self.fallback and self.codec in self.needs_fallback
+
+    def rewrite(self, doc, node, asset):
+        """
+        Point the `<source>` `node` of `asset` at the transcoded audio, keeping
+        the original as a fallback `<source>` after it if the format changed.
+        Returns the `Asset`s that the book needs for this node.
+        """
+        ext = os.path.splitext(asset.relpath)[1].lower()
+        transcoded = self.transcode(asset) if ext in self.extensions else None
+        if transcoded is None:
+            return [asset]
+        _, new_ext, mime_type = self.codecs[self.codec]
+        if new_ext == ext or not self.keeps_original():
+            node['src'] = transcoded.relpath
+            node['type'] = mime_type
+            run_stats.count('audio_bytes_saved',
+                            os.path.getsize(asset.path) - os.path.getsize(transcoded.path))
+            return [transcoded]
+        node.insert_before(doc.new_tag('source', src=transcoded.relpath, type=mime_type))
+        run_stats.count('audio_bytes_saved', -os.path.getsize(transcoded.path))
+        return [transcoded, asset]
+
+    def transcode(self, asset):
+        """
+        Return the transcoded `Asset` for the audio `asset`, or None if ffmpeg
+        failed or didn't make it smaller.
+        """
+        index_path = self.cached(
+            os.path.join(self.root, '%s-%s.json' % (os.path.basename(asset.path), self.encoding())),
+            lambda: json.dumps(self._transcode(asset.path)), asset.relpath)
+        if index_path is None:
+            return None
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except ValueError:
+            os.remove(index_path)
+            return None
+        if not index.get('digest'):
+            return None
+        path = os.path.join(asset_store.root, index['digest'])
+        if not os.path.exists(path):
+            os.remove(index_path)
+            return self.transcode(asset)
+        _, ext, _ = self.codecs[self.codec]
+        relpath = '%s.%s%s' % (os.path.splitext(asset.relpath)[0], self.encoding(), ext)
+        return Asset(relpath, path, ())
+
+    def _transcode(self, path):
+        """
+        Run ffmpeg on the audio at `path`. Returns the index entry: the digest
+        of the result (None if it's no use) and how long it took.
+        """
+        options, ext, _ = self.codecs[self.codec]
+        start = time.time()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = os.path.join(tmp_dir, 'audio' + ext)
+            command = (['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', path, '-vn', '-ac', '1']
+                       + options + ['-b:a', self.bitrate, out_path])
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                print('Could not transcode %s: %s' % (path, result.stderr.decode().strip()))
+                return dict(digest=None, seconds=time.time() - start)
+            if os.path.getsize(out_path) >= os.path.getsize(path):
+                return dict(digest=None, seconds=time.time() - start)
+            with open(out_path, 'rb') as f:
+                digest = os.path.basename(asset_store.store(f.read()))
+        return dict(digest=digest, seconds=time.time() - start)
+
+
+audio_transcoder = AudioTranscoder(MEDIA_DIR)
+
+
+class LazySlides(object):
+    """
+    Moves the `src` of the slide images and audio `<source>`s in #slide-container
+    to `data-src`, except in the first `eager` slides, so the reader only
+    decodes the slides it shows. `static/chef_end_of_body.js` loads the current
+    and next slide as the reader moves through the story.
+    """
+    # A 1x1 transparent GIF, so lazy images keep a valid `src` until loaded
+    placeholder_src = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+
+    def __init__(self):
+        self.enabled = False
+        self.eager = None
+
+    def enable(self, eager):
+        self.enabled = True
+        self.eager = max(1, eager)
+
+    def settings(self):
+        """
+        A string describing the lazy loading settings, or None if disabled.
+        """
+        if not self.enabled:
+            return None
+        return 'lazy%s' % self.eager
+
+    def apply(self, doc):
+        if not self.enabled:
+            return
+        count = 0
+        for slide in doc.select('#slide-container .slide')[self.eager:]:
+            for img in slide.select('img[src]'):
+                img['data-src'] = img['src']
+                img['src'] = self.placeholder_src
+                count += 1
+            for source in slide.select('source[src], source[srcset]'):
+                attr = 'src' if source.get('src') else 'srcset'
+                source['data-' + attr] = source[attr]
+                del source[attr]
+                count += 1
+            for audio in slide.select('audio'):
+                audio['preload'] = 'none'
+        run_stats.count('lazy_slide_resources', count)
+
+
+lazy_slides = LazySlides()
+
+
+class FontSubsetter(MediaStage):
+    """
+    Subsets the web fonts in a book to the characters its text can show: the
+    strings and text attributes of the page, the book's scripts and stylesheets,
+    and `FONT_EXTRA_CHARS`. With the 'channel' scope the characters of all books
+    seen so far, kept in `root`, are used instead, so most books share a subset.
+    Subsets are cached in `root` by font hash plus glyph set.
+    """
+    name = 'subset_fonts'
+    errors = (Exception,)           # fontTools raises all sorts on fonts it can't handle
+    extensions = ('.ttf', '.otf', '.woff', '.woff2')
+    text_extensions = ('.js', '.css', '.html')
+    text_attrs = ('alt', 'title', 'placeholder', 'value', 'aria-label')
+
+    def __init__(self, root):
+        super(FontSubsetter, self).__init__(root)
+        self.scope = None
+        self.channel_chars = set()
+        self._file_chars = {}           # path of a script or stylesheet -> its characters
+        self._lock = threading.Lock()
+
+    def enable(self, scope):
+        if font_subset is None:
+            print('fontTools is not installed, fonts will not be subset')
+            return
+        self.enabled = True
+        self.scope = scope
+        if scope == 'channel':
+            try:
+                with open(self._channel_chars_path(), encoding='utf-8') as f:
+                    self.channel_chars = set(f.read())
+            except IOError:
+                pass
+
+    def settings(self):
+        """
+        A string describing the subsetting settings, or None if disabled.
+        """
+        if not self.enabled:
+            return None
+        return 'fonts-%s' % self.scope
+
+    def _channel_chars_path(self):
+        return os.path.join(self.root, 'channel_chars.txt')
+
+    def chars(self, doc, book):
+        """
+        The characters the fonts of `book`, whose page is `doc`, need.
+        """
+        chars = set(FONT_EXTRA_CHARS)
+        for string in doc.find_all(string=True):
+            chars.update(string)
+        for node in doc.find_all(attrs={attr: True for attr in self.text_attrs}):
+            for attr in self.text_attrs:
+                chars.update(node.get(attr) or '')
+        for arcname, path in book.files():
+            if arcname.lower().endswith(self.text_extensions):
+                if path not in self._file_chars:
+                    with open(path, 'rb') as f:
+                        self._file_chars[path] = frozenset(f.read().decode('utf-8', 'replace'))
+                chars.update(self._file_chars[path])
+        chars.difference_update('\n\r\t\ufffd')
+        if self.scope == 'channel':
+            with self._lock:
+                if not chars <= self.channel_chars:
+                    self.channel_chars.update(chars)
+                    self._save_channel_chars()
+                chars = set(self.channel_chars)
+        return chars
+
+    def _save_channel_chars(self):
+        atomic_write(self._channel_chars_path(), ''.join(sorted(self.channel_chars)))
+
+    def apply(self, doc, book):
+        """
+        Replace the fonts in `book` with their subsets for the text of `doc`.
+        """
+        if not self.enabled:
+            return
+        fonts = [(arcname, path) for arcname, path in book.files()
+                 if arcname.lower().endswith(self.extensions)]
+        if not fonts:
+            return
+        chars = self.chars(doc, book)
+        for arcname, path in fonts:
+            book.replace_file(arcname, self.subset(arcname, path, chars))
+
+    def subset(self, arcname, path, chars):
+        """
+        Return the path of the subset of the font at `path` with the glyphs for
+        `chars`, or `path` itself if that fails or doesn't make it smaller.
+        """
+        ext = os.path.splitext(arcname)[1].lower()
+        out_path = self.cached(
+            os.path.join(self.root, '%s-%s%s' % (
+                self.source_hash(path), fingerprint(''.join(sorted(chars))), ext)),
+            lambda: self._subset_content(path, chars), arcname)
+        if out_path is None:
+            return path
+        run_stats.count('font_bytes_saved', os.path.getsize(path) - os.path.getsize(out_path))
+        return out_path
+
+    def _subset_content(self, path, chars):
+        with open(path, 'rb') as f:
+            original = f.read()
+        options = font_subset.Options()
+        options.layout_features = ['*']     # keep the Arabic joining forms and ligatures
+        options.name_IDs = ['*']
+        options.notdef_outline = True
+        font = font_subset.load_font(io.BytesIO(original), options)
+        options.flavor = font.flavor
+        subsetter = font_subset.Subsetter(options)
+        subsetter.populate(unicodes=[ord(char) for char in chars])
+        subsetter.subset(font)
+        output = io.BytesIO()
+        font_subset.save_font(font, output, options)
+        # Keep the original if subsetting didn't make it any smaller
+        return min(original, output.getvalue(), key=len)
+
+
+font_subsetter = FontSubsetter(os.path.join(MEDIA_DIR, 'fonts'))
+
+
+def media_settings():
+    """
+    The image, audio, font, slide loading and minification settings that went
+    into a book, for the build manifest.
+    """
+    return ','.join(filter(None, [image_optimizer.settings(), audio_transcoder.settings(),
+                                  font_subsetter.settings(), lazy_slides.settings(),
+                                  minifier.settings()])) or None
+
+
+# MINIFICATION
+################################################################################
+
+# Selector parts that can't rule a selector out: attribute selectors, and the
+# arguments of functional pseudo-classes like :not(.x)
+CSS_SELECTOR_IGNORED_RE = re.compile(r"\[[^\]]*\]|:[\w-]+\([^)]*\)|'[^']*'|\"[^\"]*\"")
+CSS_SELECTOR_NAME_RE = re.compile(r"[.#](-?[A-Za-z_\u00a0-\uffff][\w-]*)")
+CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+NAME_TOKEN_RE = re.compile(r"[\w-]+")
+# The start of a name a script builds by concatenation: 'slide-' + n, `level${x}`
+NAME_PREFIX_RE = re.compile(r"([\w-]+)['\"]\s*\+|([\w-]+)\$\{")
+# At-rules whose blocks contain style rules, which are stripped like top-level ones
+CSS_GROUPING_AT_RULES = ('@media', '@supports', '@document', '@-moz-document')
+
+
+class Minifier(MediaStage):
+    """
+    Minifies each book once all the other rewrites are done: the HTML (comments
+    and runs of whitespace), inline and linked CSS with rcssmin and JS with
+    rjsmin, when they are installed. With `strip_unused_css`, CSS rules are
+    also dropped when every selector names a class or id that appears nowhere
+    in the book's markup or scripts, and that no script could build from a
+    string it concatenates. Minified files are cached in `root` by source hash
+    plus the names that were found unused.
+    """
+    name = 'minify_files'
+    preserve_whitespace = ('pre', 'textarea', 'script', 'style')
+    js_types = ('', 'text/javascript', 'application/javascript')
+
+    def __init__(self, root):
+        super(Minifier, self).__init__(root)
+        self.strip_unused_css = False
+        self._names = {}                # path of a script -> its names and name prefixes
+
+    def enable(self, strip_unused_css):
+        self.enabled = True
+        self.strip_unused_css = strip_unused_css
+        if rcssmin is None:
+            print('rcssmin is not installed, CSS will not be minified')
+        if rjsmin is None:
+            print('rjsmin is not installed, JS will not be minified')
+
+    def settings(self):
+        """
+        A string describing the minification settings, or None if disabled.
+        """
+        if not self.enabled:
+            return None
+        return 'min-unused-css' if self.strip_unused_css else 'min'
+
+    def apply(self, doc, book):
+        """
+        Minify the stylesheets and scripts in `book`, and return the source of
+        `doc` minified the same way (or as is, if minification is disabled).
+        """
+        if not self.enabled:
+            return str(doc)
+        before = str(doc)
+        with run_stats.stage('minify'):
+            known_names = self.known_names(doc, book) if self.strip_unused_css else None
+            for arcname, path in book.files():
+                ext = os.path.splitext(arcname)[1].lower()
+                if ext in ('.css', '.js'):
+                    book.replace_file(arcname, self.minify_file(arcname, path, ext, known_names))
+            for node in doc.select('style'):
+                node.string = self.css(node.get_text(), known_names)
+            for node in doc.select('script'):
+                if not node.get('src') and node.get('type', '').lower() in self.js_types:
+                    node.string = self.js(node.get_text())
+            for comment in doc.find_all(string=lambda text: isinstance(text, Comment)):
+                if not comment.startswith('[if'):
+                    comment.extract()
+            for text in doc.find_all(string=True):
+                if type(text) is not NavigableString or text.find_parent(self.preserve_whitespace):
+                    continue
+                collapsed = re.sub(r'[ \t\n\r\f]+', ' ', text)
+                if collapsed != text:
+                    text.replace_with(collapsed)
+            after = str(doc)
+        self._count('html', len(before.encode('utf-8')), len(after.encode('utf-8')))
+        return after
+
+    def known_names(self, doc, book):
+        """
+        The `KnownNames` of `book`: the words of the attribute values and inline
+        scripts of `doc` and of the book's scripts, and the prefixes they build
+        names from.
+        """
+        texts = [node.get_text() for node in doc.select('script')]
+        for node in doc.find_all(True):
+            for value in node.attrs.values():
+                texts.append(' '.join(value) if isinstance(value, list) else value)
+        names, prefixes = set(), set()
+        for text in texts:
+            names.update(NAME_TOKEN_RE.findall(text))
+            prefixes.update(''.join(match) for match in NAME_PREFIX_RE.findall(text))
+        for arcname, path in book.files():
+            if arcname.lower().endswith(('.js', '.html')):
+                if path not in self._names:
+                    with open(path, 'rb') as f:
+                        text = f.read().decode('utf-8', 'replace')
+                    self._names[path] = (
+                        frozenset(NAME_TOKEN_RE.findall(text)),
+                        frozenset(''.join(match) for match in NAME_PREFIX_RE.findall(text)))
+                names.update(self._names[path][0])
+                prefixes.update(self._names[path][1])
+        return KnownNames(names, prefixes)
+
+    def minify_file(self, arcname, path, ext, known_names):
+        """
+        Return the path of the minified version of the stylesheet or script at `path`.
+        """
+        with open(path, 'rb') as f:
+            content = f.read().decode('utf-8', 'replace')
+        key = self.settings()
+        if ext == '.css' and known_names is not None:
+            unused = sorted(name for name in set(CSS_SELECTOR_NAME_RE.findall(content))
+                            if name not in known_names)
+            key += '-' + fingerprint(' '.join(unused))
+        out_path = self.cached(
+            os.path.join(self.root, '%s-%s%s' % (self.source_hash(path), key, ext)),
+            lambda: (self.css(content, known_names) if ext == '.css'
+                     else self.js(content)).encode('utf-8'),
+            arcname)
+        if out_path is None:
+            return path
+        self._count(ext[1:], os.path.getsize(path), os.path.getsize(out_path))
+        return out_path
+
+    def css(self, content, known_names=None):
+        if known_names is not None:
+            content = strip_unused_css(content, known_names)
+        return rcssmin.cssmin(content) if rcssmin else content
+
+    def js(self, content):
+        return rjsmin.jsmin(content) if rjsmin else content
+
+    def _count(self, kind, before, after):
+        run_stats.count('minify_%s_bytes_before' % kind, before)
+        run_stats.count('minify_%s_bytes_after' % kind, after)
+
+
+minifier = Minifier(os.path.join(MEDIA_DIR, 'minified'))
+
+
+class KnownNames(object):
+    """
+    The classes and ids a book may use: the tokens in `names`, and any name
+    that starts with one of `prefixes`, which scripts build names from.
+    """
+    def __init__(self, names, prefixes):
+        self.names = names
+        self.prefixes = tuple(sorted(prefixes))
+
+    def __contains__(self, name):
+        return name in self.names or name.startswith(self.prefixes)
+
+
+def strip_unused_css(content, known_names):
+    """
+    Drop the style rules of `content` (also inside @media and similar blocks)
+    whose selectors all name a class or id that isn't in `known_names`.
+    """
+    out = []
+    for prelude, body, text in css_blocks(content):
+        if body is None:
+            out.append(text)
+            continue
+        head = CSS_COMMENT_RE.sub('', prelude).strip()
+        if head.lower().startswith(CSS_GROUPING_AT_RULES):
+            inner = strip_unused_css(body, known_names)
+            if inner.strip():
+                out.append('%s{%s}' % (prelude, inner))
+        elif head.startswith('@') or not all(
+                is_unused_selector(selector, known_names)
+                for selector in split_top_level(head, ',')):
+            out.append(text)
+    return ''.join(out)
+
+
+def is_unused_selector(selector, known_names):
+    names = CSS_SELECTOR_NAME_RE.findall(CSS_SELECTOR_IGNORED_RE.sub('', selector))
+    return any(name not in known_names for name in names)
+
+
+def css_blocks(content):
+    """
+    Split CSS into its top-level statements, yielding `(prelude, body, text)`
+    for each: `body` is None for statements without a block (like `@import`)
+    and for whitespace or unterminated text, which are passed through as is.
+    """
+    i, n = 0, len(content)
+    while i < n:
+        start = i
+        depth = 0
+        prelude_end = None
+        while i < n:
+            char = content[i]
+            if content.startswith('/*', i):
+                end = content.find('*/', i + 2)
+                i = n if end < 0 else end + 2
+                continue
+            if char in '"\'':
+                i = skip_css_string(content, i)
+                continue
+            if char == '{':
+                if depth == 0:
+                    prelude_end = i
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            elif char == ';' and depth == 0:
+                i += 1
+                break
+            i += 1
+        text = content[start:i]
+        if prelude_end is None or depth != 0:
+            yield text, None, text
+        else:
+            yield content[start:prelude_end], content[prelude_end + 1:i - 1], text
+
+
+def skip_css_string(content, i):
+    quote = content[i]
+    i += 1
+    while i < len(content) and content[i] != quote:
+        i += 2 if content[i] == '\\' else 1
+    return i + 1
+
+
+def split_top_level(text, separator):
+    """
+    Split `text` on `separator`, except inside parentheses or brackets.
+    """
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+# REQUEST SCHEDULING
+################################################################################
+
+class HostUnavailable(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    """
+
+
+class HostState(object):
+    """
+    Token bucket and failure tracking for one host. The rate is halved when the
+    host throttles us and grows back slowly while requests succeed.
+    """
+    def __init__(self, rate, burst):
+        self.max_rate = self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.not_before = 0             # set from Retry-After, pauses the whole host
+        self.failures = 0               # consecutive failures
+        self.open_until = 0             # circuit is open until this time
+
+
+class RequestScheduler(object):
+    """
+    Decides when requests to each host may be sent, how long to back off
+    between retries, and when to stop trying a host that keeps failing.
+    """
+    def __init__(self, rate_limits, default_rate_limit):
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState(*self.rate_limits.get(host, self.default_rate_limit))
+        return self.hosts[host]
+
+    def acquire(self, host):
+        """
+        Block until a request to `host` may be sent.
+        """
+        while True:
+            with self._lock:
+                state = self._host(host)
+                now = time.time()
+                if now < state.open_until:
+                    raise HostUnavailable('Too many failures from %s, skipping it for %ds'
+                                          % (host, state.open_until - now))
+                state.tokens = min(state.burst,
+                                   state.tokens + (now - state.updated_at) * state.rate)
+                state.updated_at = now
+                wait = state.not_before - now
+                if wait <= 0 and state.tokens >= 1:
+                    state.tokens -= 1
+                    return
+                wait = max(wait, (1 - state.tokens) / state.rate)
+            run_stats.count('throttle_waits')
+            time.sleep(wait)
+
+    def succeeded(self, host):
+        with self._lock:
+            state = self._host(host)
+            state.failures = 0
+            state.rate = min(state.max_rate, state.rate + 0.1)
+
+    def failed(self, host, throttled=False, retry_after=None):
+        """
+        Record a failed request to `host`, and return how many seconds to wait
+        before retrying it.
+        """
+        with self._lock:
+            state = self._host(host)
+            state.failures += 1
+            if state.failures >= CIRCUIT_FAILURES:
+                print('Too many failures from %s, skipping it for %ds' % (host, CIRCUIT_COOLDOWN))
+                state.open_until = time.time() + CIRCUIT_COOLDOWN
+                run_stats.count('circuit_opened')
+            if throttled:
+                state.rate = max(MIN_RATE, state.rate / 2)
+            if retry_after is not None:
+                delay = min(retry_after, BACKOFF_MAX)
+                state.not_before = max(state.not_before, time.time() + delay)
+                return delay
+            # Full jitter, so threads that failed together don't retry together
+            return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (state.failures - 1)))
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a `Retry-After` header, or None.
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+    Transport adapter that waits for the scheduler before each request that
+    goes to the network.
+    """
+    def send(self, request, **kwargs):
+        request_scheduler.acquire(urlparse(request.url).netloc)
+        return super(ScheduledAdapter, self).send(request, **kwargs)
+
+
+class FailedResponse(requests.Response):
+    """
+    Returned by `make_request` when `url` could not be fetched. Like a real
+    response it has a (non-200) status code, but its content is empty.
+    """
+    def __init__(self, url, reason, status_code=None):
+        super(FailedResponse, self).__init__()
+        self.url = url
+        self.reason = reason
+        self.status_code = status_code or 503
+        self._content = b''
+        self.from_cache = False
+
+
+request_scheduler = RequestScheduler(HOST_RATE_LIMITS, DEFAULT_RATE_LIMIT)
+
+
+# HTTP CACHE
+################################################################################
+
+class HTTPCache(object):
+    """
+    Single-file SQLite cache of HTTP responses, keyed by URL. The total size of
+    the cached bodies is kept under `max_bytes` by evicting the least recently
+    used responses.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        # Opened on first use, so importing the chef doesn't create the file
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY, headers TEXT, body BLOB, size INTEGER,
+                fetched_at REAL, accessed_at REAL)""")
+            self._db.execute('CREATE INDEX IF NOT EXISTS lru ON responses (accessed_at)')
+            self._size = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._db
+
+    def get(self, url):
+        with self._lock:
+            row = self.db.execute('SELECT headers, body, fetched_at FROM responses WHERE url = ?',
+                                  (url,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self.db.commit()
+        return dict(headers=json.loads(row[0]), body=row[1], fetched_at=row[2])
+
+    def set(self, url, headers, body):
+        now = time.time()
+        with self._lock:
+            old = self.db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (url, json.dumps(headers), body, len(body), now, now))
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict(self.max_bytes)
+            self.db.commit()
+
+    def touch(self, url):
+        """
+        Mark the response for `url` as just revalidated.
+        """
+        with self._lock:
+            self.db.execute('UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+            self.db.commit()
+
+    def prune(self, max_bytes=None):
+        with self._lock:
+            db = self.db            # opening it reads the current size for _evict
+            evicted = self._evict(self.max_bytes if max_bytes is None else max_bytes)
+            db.commit()
+        db.execute('VACUUM')
+        return evicted
+
+    def _evict(self, max_bytes):
+        evicted = 0
+        while self._size > max_bytes:
+            rows = self.db.execute(
+                'SELECT url, size FROM responses ORDER BY accessed_at LIMIT 100').fetchall()
+            if not rows:
+                break
+            for url, size in rows:
+                if self._size <= max_bytes:
+                    break
+                self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._size -= size
+                evicted += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            count, oldest, newest = self.db.execute(
+                'SELECT COUNT(*), MIN(fetched_at), MAX(fetched_at) FROM responses').fetchone()
+        return dict(path=self.path, responses=count, size_mb=self._size / 1048576.0,
+                    max_mb=self.max_bytes / 1048576.0, oldest=oldest, newest=newest)
+
+
+class RevalidatingCacheAdapter(ScheduledAdapter):
+    """
+    Transport adapter that answers GET requests from `cache` while a response
+    is less than `fresh_seconds` old. Older responses are revalidated with a
+    conditional request (ETag / Last-Modified) and only refetched in full if
+    they changed. Responses served from the cache have `from_cache` set.
+    """
+    def __init__(self, cache, fresh_seconds, *args, **kwargs):
+        super(RevalidatingCacheAdapter, self).__init__(*args, **kwargs)
+        self.cache = cache
+        self.fresh_seconds = fresh_seconds
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(RevalidatingCacheAdapter, self).send(request, **kwargs)
+        entry = self.cache.get(request.url)
+        if entry and time.time() - entry['fetched_at'] < self.fresh_seconds:
+            return self._cached_response(request, entry)
+        if entry:
+            cached_headers = CaseInsensitiveDict(entry['headers'])
+            if 'etag' in cached_headers:
+                request.headers['If-None-Match'] = cached_headers['etag']
+            if 'last-modified' in cached_headers:
+                request.headers['If-Modified-Since'] = cached_headers['last-modified']
+
+        response = super(RevalidatingCacheAdapter, self).send(request, **kwargs)
+        if entry and response.status_code == 304:
+            self.cache.touch(request.url)
+            return self._cached_response(request, entry)
+        response.from_cache = False
+        if response.status_code == 200 and 'no-store' not in response.headers.get('cache-control', ''):
+            # The body is stored decoded, so drop the headers describing the encoding
+            stored_headers = {key: value for key, value in response.headers.items()
+                              if key.lower() not in ('content-encoding', 'content-length',
+                                                     'transfer-encoding')}
+            self.cache.set(request.url, stored_headers, response.content)
+        return response
+
+    def _cached_response(self, request, entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry['body']
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        return response
+
+
+http_cache = HTTPCache(HTTP_CACHE_PATH, HTTP_CACHE_MAX_MB * 1024 * 1024)
+
+sess = requests.Session()
+sess.mount('http://', ScheduledAdapter())
+sess.mount('https://', ScheduledAdapter())
+chefdev_adapter = RevalidatingCacheAdapter(http_cache, HTTP_CACHE_FRESH_HOURS * 3600)
+sess.mount('http://3asafeer.com/', chefdev_adapter)
+sess.mount('http://fonts.googleapis.com/', chefdev_adapter)
+sess.mount('http://fonts.gstatic.com/', chefdev_adapter)
+
+_thread_sessions = threading.local()
+
+
+def thread_session():
+    """
+    The calling thread's own session. A cookie jar isn't safe to clear or
+    update from several threads at once, so each thread gets its own, while
+    the adapters (and so the connection pools, cache and scheduling) are
+    those of `sess`, mounts included.
+    """
+    session = getattr(_thread_sessions, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.adapters = sess.adapters
+        session.headers = sess.headers
+        _thread_sessions.session = session
+    return session
+
+
+def cache_command(argv):
+    """
+    `./chef.py cache stats|prune|clear`: inspect and prune the HTTP cache.
+    """
+    parser = argparse.ArgumentParser(prog='chef.py cache', description=cache_command.__doc__)
+    parser.add_argument('action', choices=['stats', 'prune', 'clear'])
+    parser.add_argument('--max-mb', type=float, default=HTTP_CACHE_MAX_MB,
+                        help='Size to prune the cache down to.')
+    args = parser.parse_args(argv)
+    if args.action == 'prune':
+        print('Evicted %s responses' % http_cache.prune(int(args.max_mb * 1024 * 1024)))
+    elif args.action == 'clear':
+        print('Evicted %s responses' % http_cache.prune(0))
+    for key, value in sorted(http_cache.stats().items()):
+        if key in ('oldest', 'newest') and value:
+            value = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))
+        print('%s: %s' % (key, value))
 
 
 url_blacklist = [
@@ -618,28 +3378,56 @@ def is_blacklisted(url):
     return any((item in url) for item in url_blacklist)
 
 
-def derive_filename(url):
-    return "%s.%s" % (uuid.uuid4().hex, os.path.basename(urlparse(url).path))
+def derive_filename(url, digest):
+    return "%s.%s" % (digest[:16], os.path.basename(urlparse(url).path))
 
 
 def make_request(url, clear_cookies=True, timeout=60, *args, **kwargs):
+    with run_stats.stage('make_request'):
+        response = _make_request(url, clear_cookies, timeout, *args, **kwargs)
+    run_stats.count('requests')
+    run_stats.count('bytes_fetched', len(response.content))
+    run_stats.count('cache_hits' if getattr(response, 'from_cache', False) else 'cache_misses')
+    return response
+
+
+def _make_request(url, clear_cookies=True, timeout=60, *args, **kwargs):
     # print('Making request to', url)
+    session = thread_session()
     if clear_cookies:
-        sess.cookies.clear()
+        session.cookies.clear()
 
+    host = urlparse(url).netloc
     retry_count = 0
-    max_retries = 5
     while True:
         try:
-            response = sess.get(url, headers=headers, timeout=timeout, *args, **kwargs)
-            break
+            response = session.get(url, headers=headers, timeout=timeout, *args, **kwargs)
+        except HostUnavailable as e:
+            print("Skipping", url, "-", e)
+            return FailedResponse(url, str(e))
         except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-            retry_count += 1
-            print("Error with connection ('{msg}'); about to perform retry {count} of {trymax}."
-                  .format(msg=str(e), count=retry_count, trymax=max_retries))
-            time.sleep(retry_count * 1)
-            if retry_count >= max_retries:
-                return Dummy404ResponseObject(url=url)
+            error, response = str(e), None
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                request_scheduler.succeeded(host)
+                break
+            error = 'HTTP %s' % response.status_code
+
+        retry_after = (parse_retry_after(response.headers.get('Retry-After'))
+                       if response is not None else None)
+        delay = request_scheduler.failed(host, throttled=response is not None and
+                                         response.status_code in (429, 503),
+                                         retry_after=retry_after)
+        if retry_count >= MAX_RETRIES:
+            print("Giving up on", url, "after", retry_count, "retries:", error)
+            if response is None:
+                return FailedResponse(url, error)
+            break
+        retry_count += 1
+        run_stats.count('retries')
+        print("Error with connection ('{msg}'); about to perform retry {count} of {trymax} in {delay:.1f}s."
+              .format(msg=error, count=retry_count, trymax=MAX_RETRIES, delay=delay))
+        time.sleep(delay)
 
     if response.status_code != 200:
         print("NOT FOUND:", url)
@@ -661,9 +3449,233 @@ def make_fully_qualified_url(url):
     return url
 
 
+# RUN STATS
+################################################################################
+
+class RunStats(object):
+    """
+    Timings and counters collected during the run, per book. Work done in a
+    thread is attributed to the book that thread is working on, see `book()`
+    and `in_current_book()`. Stage times are inclusive: `download_book`
+    contains the `make_request` calls made while it runs, for example.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.books = OrderedDict()          # book_id -> dict of stats
+        self.assets = []                    # dicts with url, seconds and bytes
+        self.waits = {}                     # readiness wait name -> summary
+        self.totals = defaultdict(float)    # counters and stage times for the run
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def current_book(self):
+        return getattr(self._local, 'book_id', None)
+
+    @contextmanager
+    def book(self, book_id):
+        """
+        Attribute everything the current thread does to `book_id`.
+        """
+        stats = dict(book_id=book_id, status=None, seconds=0,
+                     stages=defaultdict(float), counters=defaultdict(int))
+        with self._lock:
+            self.books[book_id] = stats
+        previous, self._local.book_id = self.current_book(), book_id
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] = time.time() - start
+            stats['peak_rss_mb'] = peak_rss_mb()
+            stats['rss_mb'] = current_rss_mb()
+            self._local.book_id = previous
+
+    def in_current_book(self, fn):
+        """
+        Wrap `fn` so that it is attributed to the current book in any thread.
+        """
+        book_id = self.current_book()
+
+        def wrapper(*args, **kwargs):
+            previous, self._local.book_id = self.current_book(), book_id
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.book_id = previous
+        return wrapper
+
+    def _book_stats(self):
+        return self.books.get(self.current_book())
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self._lock:
+                self.totals['%s_seconds' % name] += seconds
+                stats = self._book_stats()
+                if stats:
+                    stats['stages'][name] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.totals[name] += n
+            stats = self._book_stats()
+            if stats:
+                stats['counters'][name] += n
+
+    def set_status(self, status):
+        stats = self._book_stats()
+        if stats:
+            stats['status'] = status
+
+    def asset(self, url, seconds, size):
+        with self._lock:
+            self.assets.append(dict(url=url, book_id=self.current_book(),
+                                    seconds=seconds, bytes=size))
+
+    def wait(self, name, timings):
+        self.waits[name] = dict(count=len(timings), total=sum(timings), max=max(timings))
+
+    def report(self, top=20):
+        books = list(self.books.values())
+        return dict(
+            started_at=self.started_at,
+            seconds=time.time() - self.started_at,
+            peak_rss_mb=peak_rss_mb(),
+            memory=memory_budget.report(),
+            totals=dict(self.totals),
+            statuses=dict(Counter(stats['status'] for stats in books)),
+            waits=self.waits,
+            slowest_books=sorted(books, key=lambda stats: -stats['seconds'])[:top],
+            slowest_assets=sorted(self.assets, key=lambda asset: -asset['seconds'])[:top],
+            books=books,
+        )
+
+    def write_report(self, path):
+        report = self.report()
+        atomic_write(path, json.dumps(report, indent=2))
+        print('Run report written to %s: %s books in %.0fs, %s, peak RSS %.0f MB' % (
+            path, len(report['books']), report['seconds'], report['statuses'],
+            report['peak_rss_mb']))
+        if memory_budget.max_rss_mb:
+            print('  - memory: peak %.0f MB with browsers, budget %s MB, exceeded before %s books' % (
+                report['memory']['peak_mb'], memory_budget.max_rss_mb,
+                report['memory']['books_over_budget']))
+        if 'audio_bytes_saved' in report['totals']:
+            print('  - audio transcoding saved %.1f MB in %.0fs' % (
+                report['totals']['audio_bytes_saved'] / 1048576.0,
+                report['totals'].get('transcode_audio_seconds', 0)))
+        if 'image_bytes_saved' in report['totals']:
+            print('  - image optimization saved %.1f MB' % (
+                report['totals']['image_bytes_saved'] / 1048576.0))
+        for kind in ('html', 'css', 'js'):
+            if 'minify_%s_bytes_before' % kind in report['totals']:
+                print('  - minified %s: %.1f MB -> %.1f MB' % (
+                    kind, report['totals']['minify_%s_bytes_before' % kind] / 1048576.0,
+                    report['totals']['minify_%s_bytes_after' % kind] / 1048576.0))
+        for stats in report['slowest_books'][:5]:
+            print('  - slow book %s: %.1fs' % (stats['book_id'], stats['seconds']))
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    # ru_maxrss is in kilobytes on Linux (and in bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def current_rss_mb():
+    """
+    Memory used right now by the chef and its child processes (the browsers),
+    or the chef's peak memory where /proc isn't available.
+    """
+    pids, total_kb = [str(os.getpid())], 0
+    try:
+        while pids:
+            pid = pids.pop()
+            with open('/proc/%s/status' % pid) as f:
+                total_kb += next((int(line.split()[1]) for line in f
+                                  if line.startswith('VmRSS:')), 0)
+            for task in os.listdir('/proc/%s/task' % pid):
+                with open('/proc/%s/task/%s/children' % (pid, task)) as f:
+                    pids.extend(f.read().split())
+    except (IOError, OSError):
+        if not total_kb:
+            return peak_rss_mb()
+    return total_kb / 1024.0
+
+
+run_stats = RunStats()
+
+
+# MEMORY
+################################################################################
+
+class MemoryBudget(object):
+    """
+    Keeps the chef and its browsers under `max_rss_mb`. Before each book, if
+    the budget is exceeded, garbage is collected and idle browser sessions are
+    shut down; if that isn't enough, books start one at a time until memory is
+    back under budget.
+    """
+    def __init__(self):
+        self.low_memory = False
+        self.max_rss_mb = None
+        self.peak_mb = 0
+        self.books_over_budget = 0
+        self._one_at_a_time = threading.Lock()
+
+    def configure(self, low_memory, max_rss_mb):
+        self.low_memory = low_memory
+        self.max_rss_mb = max_rss_mb
+        if max_rss_mb and resource is None:
+            print('Memory use is not measured on this platform, --max-rss-mb has no effect')
+
+    @contextmanager
+    def book_slot(self, pool):
+        if not self.max_rss_mb:
+            yield
+            return
+        rss = self._sample()
+        if rss > self.max_rss_mb:
+            gc.collect()
+            pool.release_idle()
+            rss = self._sample()
+        if rss <= self.max_rss_mb:
+            yield
+            return
+        print('Using %.0f MB, over the %s MB budget: processing books one at a time' % (
+            rss, self.max_rss_mb))
+        self.books_over_budget += 1
+        run_stats.count('over_memory_budget')
+        with self._one_at_a_time:
+            yield
+
+    def _sample(self):
+        rss = current_rss_mb()
+        self.peak_mb = max(self.peak_mb, rss)
+        return rss
+
+    def report(self):
+        return dict(low_memory=self.low_memory, max_rss_mb=self.max_rss_mb,
+                    peak_mb=max(self.peak_mb, current_rss_mb()),
+                    books_over_budget=self.books_over_budget)
+
+
+memory_budget = MemoryBudget()
+
+
 if __name__ == '__main__':
     """
     This code will run when the sushi chef is called from the command line.
     """
+    if sys.argv[1:2] == ['cache']:
+        cache_command(sys.argv[2:])
+        sys.exit(0)
     chef = ThreeAsafeerChef()
     chef.main()
@@ -5,4 +5,90 @@ setTimeout(function() {
   $.extend(window.story, window._story);
   adjustReaderDimensions();
   animateButtons(0.9);            // This is necessary to force-show the buttons
+  loadVisibleSlides();
 }, 500);
+
+
+// Lazy slides (chef --lazy-slides): slide images and audio after the first few
+// slides have their src in data-src. Load the slide on screen and the next one
+// whenever the reader may have moved to another slide.
+function lazySlides() {
+  return document.querySelectorAll('#slide-container .slide');
+}
+
+function loadSlide(slide) {
+  if (!slide) {
+    return;
+  }
+  var pending = slide.querySelectorAll('[data-src], [data-srcset]');
+  for (var i = 0; i < pending.length; i++) {
+    var el = pending[i];
+    if (el.hasAttribute('data-src')) {
+      el.setAttribute('src', el.getAttribute('data-src'));
+      el.removeAttribute('data-src');
+    }
+    if (el.hasAttribute('data-srcset')) {
+      el.setAttribute('srcset', el.getAttribute('data-srcset'));
+      el.removeAttribute('data-srcset');
+    }
+  }
+  if (pending.length) {
+    var audios = slide.querySelectorAll('audio');
+    for (var j = 0; j < audios.length; j++) {
+      audios[j].load();
+    }
+  }
+}
+
+function currentSlideIndex(slides) {
+  // The slide that covers most of the reader viewport
+  var viewport = document.getElementById('reader-viewport') || document.documentElement;
+  var view = viewport.getBoundingClientRect();
+  var best = 0, bestArea = -1;
+  for (var i = 0; i < slides.length; i++) {
+    var rect = slides[i].getBoundingClientRect();
+    var width = Math.min(rect.right, view.right) - Math.max(rect.left, view.left);
+    var height = Math.min(rect.bottom, view.bottom) - Math.max(rect.top, view.top);
+    var area = Math.max(0, width) * Math.max(0, height);
+    if (area > bestArea) {
+      best = i;
+      bestArea = area;
+    }
+  }
+  return best;
+}
+
+function loadVisibleSlides() {
+  if (!document.querySelector('#slide-container [data-src], #slide-container [data-srcset]')) {
+    return;
+  }
+  var slides = lazySlides();
+  var current = currentSlideIndex(slides);
+  loadSlide(slides[current]);
+  loadSlide(slides[current + 1]);
+}
+
+(function() {
+  var timer = null;
+  function scheduleLoad() {
+    // Let the reader finish moving to the new slide first
+    clearTimeout(timer);
+    timer = setTimeout(loadVisibleSlides, 300);
+  }
+  ['click', 'touchend', 'keyup', 'transitionend', 'webkitTransitionEnd', 'resize'].forEach(
+    function(type) {
+      (type === 'resize' ? window : document).addEventListener(type, scheduleLoad, true);
+    });
+  // Audio played before its slide was loaded (e.g. when jumping ahead)
+  document.addEventListener('play', function(event) {
+    var audio = event.target;
+    if (audio.querySelector && audio.querySelector('[data-src], [data-srcset]')) {
+      var slide = audio.parentNode;
+      while (slide && !(slide.classList && slide.classList.contains('slide'))) {
+        slide = slide.parentNode;
+      }
+      loadSlide(slide || audio.parentNode);
+      audio.play();
+    }
+  }, true);
+})();